@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+
+class AudioCache:
+    """Generated audio stored on disk, addressed by the hash of (text, lang, voice, format).
+
+    The least recently used files are deleted when the files take more than max_bytes. Telegram file ids of sent audio
+    are remembered per bot, so that audio that was uploaded once is sent again by its id. Files are read and written
+    in worker threads, so the event loop never waits for the disk.
+    """
+
+    def __init__(self, path, max_bytes=200 * 1024 * 1024, max_file_ids=10000):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_file_ids = max_file_ids
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._sizes = OrderedDict()  # file name -> size, most recently used last
+        self._n_bytes = 0
+        self._file_ids = OrderedDict()  # (bot token, key) -> telegram file id
+        self._in_flight = dict()  # key -> task generating the audio
+        self.n_hits = 0
+        self.n_misses = 0
+
+        # the modification time is updated on every read, so it orders the files by their last use
+        files = [entry for entry in os.scandir(self.path) if entry.is_file() and not entry.name.endswith('.tmp')]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            self._sizes[entry.name] = entry.stat().st_size
+            self._n_bytes += entry.stat().st_size
+        self._remove_files(self._evict())
+
+    @staticmethod
+    def make_key(text, lang, voice, audio_format) -> str:
+        return hashlib.sha256('\x1f'.join([text, lang, voice, audio_format]).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _file_name(key, audio_format):
+        return f'{key}.{audio_format}'
+
+    def _evict(self) -> list:
+        # returns the names of the evicted files, they are deleted by _remove_files
+        names = []
+        while self._n_bytes > self.max_bytes and len(self._sizes) > 0:
+            name, size = self._sizes.popitem(last=False)
+            self._n_bytes -= size
+            names.append(name)
+        return names
+
+    def _remove_files(self, names):
+        for name in names:
+            try:
+                os.remove(self.path / name)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _read(file_path) -> Optional[bytes]:
+        try:
+            with open(file_path, 'rb') as fp:
+                data = fp.read()
+            os.utime(file_path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write(file_path, data):
+        # written to a temporary file first, so that a crash does not leave a truncated file in the cache
+        tmp_path = file_path.with_name(file_path.name + '.tmp')
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, file_path)
+
+    async def get(self, key, audio_format) -> Optional[bytes]:
+        name = self._file_name(key, audio_format)
+        if name not in self._sizes:
+            return None
+        self._sizes.move_to_end(name)
+        data = await asyncio.to_thread(self._read, self.path / name)
+        if data is None and name in self._sizes:
+            # deleted outside of the cache
+            self._n_bytes -= self._sizes.pop(name)
+        return data
+
+    async def put(self, key, audio_format, data: bytes) -> None:
+        name = self._file_name(key, audio_format)
+        await asyncio.to_thread(self._write, self.path / name, data)
+        self._n_bytes += len(data) - self._sizes.pop(name, 0)
+        self._sizes[name] = len(data)
+        evicted = self._evict()
+        if len(evicted) > 0:
+            await asyncio.to_thread(self._remove_files, evicted)
+
+    async def get_or_generate(self, text, lang, voice, audio_format, generate: Callable[[], Awaitable[bytes]]) -> bytes:
+        """Returns the cached audio, or generates it with generate() and caches it.
+
+        Concurrent requests for the same audio share one generation.
+        """
+        key = self.make_key(text, lang, voice, audio_format)
+        data = await self.get(key, audio_format)
+        if data is not None:
+            self.n_hits += 1
+            return data
+        self.n_misses += 1
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(key, audio_format, generate))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _generate(self, key, audio_format, generate):
+        data = await generate()
+        try:
+            await self.put(key, audio_format, data)
+        except OSError as e:
+            # the audio can still be sent
+            print(f'Could not cache audio: {e}')
+        return data
+
+    def get_file_id(self, bot_token, key) -> Optional[str]:
+        file_id = self._file_ids.get((bot_token, key))
+        if file_id is not None:
+            self._file_ids.move_to_end((bot_token, key))
+        return file_id
+
+    def set_file_id(self, bot_token, key, file_id: Optional[str]) -> None:
+        # file ids are only valid for the bot that uploaded the file, None forgets the id
+        if file_id is None:
+            self._file_ids.pop((bot_token, key), None)
+            return
+        self._file_ids[(bot_token, key)] = file_id
+        self._file_ids.move_to_end((bot_token, key))
+        while len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
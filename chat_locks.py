@@ -0,0 +1,21 @@
+import asyncio
+import weakref
+
+
+class ChatLocks:
+    """One asyncio lock per chat.
+
+    Updates of a chat hold its lock while they are handled, so they are handled one at a time and in the order in
+    which they arrived, while updates of different chats are handled concurrently. A lock is dropped as soon as
+    nobody holds or waits for it.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def __call__(self, chat_id) -> asyncio.Lock:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[chat_id] = lock
+        return lock
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+
+class DailyActivityCounters:
+    """Counts words reviewed by each user during the user's local day.
+
+    A word counts once per day however many times it is reviewed, as a test if it has been tested at least once.
+    Counters are kept up to date from progress changes and start from scratch at the user's local midnight.
+    """
+
+    def __init__(self, user_config, clock=datetime.now):
+        self.user_config = user_config
+        self.clock = clock
+        self._counters = dict()  # chat_id -> (local date, ids of words reviewed today, ids of words tested today)
+
+    def _local_date(self, chat_id, timestamp=None):
+        tz = self.user_config.get_user_timezone(chat_id)
+        if timestamp is None:
+            return self.clock().astimezone(tz).date()
+        # review dates are naive timestamps in the local time of the server
+        if isinstance(timestamp, pd.Timestamp):
+            timestamp = timestamp.to_pydatetime()
+        return timestamp.astimezone(tz).date()
+
+    def _today_counters(self, chat_id):
+        today = self._local_date(chat_id)
+        counters = self._counters.get(chat_id)
+        if counters is None or counters[0] != today:
+            counters = (today, set(), set())
+            self._counters[chat_id] = counters
+        return counters
+
+    def rebuild(self, progress_df: pd.DataFrame) -> None:
+        self._counters = dict()
+        # timezones differ by at most 26 hours, older reviews cannot belong to anybody's today
+        recent = progress_df[progress_df['last_review_date'] >= pd.Timestamp(self.clock().date() - timedelta(days=2))]
+        for chat_id, word_id, last_review_date, num_reps in zip(recent['chat_id'], recent['word_id'], recent['last_review_date'], recent['num_reps']):
+            self.update(int(chat_id), int(word_id), dict(last_review_date=last_review_date, num_reps=num_reps))
+
+    def update(self, chat_id, word_id, progress) -> None:
+        today, done, tested = self._today_counters(chat_id)
+        if progress is None or pd.isna(progress['last_review_date']) or self._local_date(chat_id, progress['last_review_date']) != today:
+            done.discard(word_id)
+            tested.discard(word_id)
+            return
+        done.add(word_id)
+        if progress['num_reps'] > 0:
+            tested.add(word_id)
+        else:
+            tested.discard(word_id)
+
+    def n_done_today(self, chat_id) -> int:
+        return len(self._today_counters(chat_id)[1])
+
+    def n_tests_done_today(self, chat_id) -> int:
+        return len(self._today_counters(chat_id)[2])
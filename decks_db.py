@@ -7,79 +7,100 @@ import pandas as pd
 
 
 class DecksDB:
-    def __init__(self, decks_path, deck_word_db_path):
-        self.decks_path = decks_path
-        self.deck_word_db_path = deck_word_db_path
-        self.decks = pd.read_csv(self.decks_path)
+    def __init__(self, storage):
+        self.storage = storage
+        self.decks = self.storage.load('decks')
         self.decks['owner'] = self.decks['owner'].astype(str)
-        self.deck_word = pd.read_csv(self.deck_word_db_path)
+        self.deck_word = self.storage.load('deck_word')
         self.decks['id'] = self.decks['id'].astype(int)
         self.deck_word['deck_id'] = self.deck_word['deck_id'].astype(int)
         self.deck_word['word_id'] = self.deck_word['word_id'].astype(int)
+        self._deck_index = dict(zip(self.decks['id'], self.decks.index))
+        self._listeners = []
+        # readers share snapshots of the tables, published once by every change. They are shallow copies, copy on
+        # write keeps them unchanged by the later changes of the tables.
+        self.version = 0
+        self._decks_snapshot = self.decks.copy(deep=False)
+        self._deck_word_snapshot = self.deck_word.copy(deep=False)
         self._lock = threading.Lock()
 
+    def add_listener(self, callback):
+        # callback(deck_id, word_id) is called after a word is added to a deck
+        self._listeners.append(callback)
+
+    def get_deck(self, deck_id: int):
+        with self._lock:
+            label = self._deck_index.get(int(deck_id))
+            res = None if label is None else self.decks.loc[label].to_dict()
+        return res
+
     def get_decks_df(self):
-        self._lock.acquire()
-        pdf_cpy = self.decks.copy()
-        self._lock.release()
-        return pdf_cpy
+        # the returned DataFrame is shared between callers and must not be modified
+        with self._lock:
+            snapshot = self._decks_snapshot
+        return snapshot
 
     def get_deck_word_df(self):
-        self._lock.acquire()
-        pdf_cpy = self.deck_word.copy()
-        self._lock.release()
-        return pdf_cpy
+        # the returned DataFrame is shared between callers and must not be modified
+        with self._lock:
+            snapshot = self._deck_word_snapshot
+        return snapshot
 
     def get_decks_lang(self, owner: str, lang: str):
         # returns an array of dictionaries
-        self._lock.acquire()
-        owner_lang_data = self.decks.loc[self.decks['owner'].isin([owner, str(owner), 'common']) & (self.decks['language'] == lang)]
-        res = [dict(id=data['id'], owner=data['owner'], name=data['name'], language=data['name'], tags=data['tags']) for d, data in owner_lang_data.iterrows()]
-        self._lock.release()
+        with self._lock:
+            owner_lang_data = self.decks.loc[self.decks['owner'].isin([owner, str(owner), 'common']) & (self.decks['language'] == lang)]
+            res = [dict(id=data['id'], owner=data['owner'], name=data['name'], language=data['name'], tags=data['tags']) for d, data in owner_lang_data.iterrows()]
         return res
 
     def get_deck_words(self, deck_id: int):
-        self._lock.acquire()
-        res = self.deck_word.loc[self.deck_word['deck_id'] == deck_id, 'word_id'].to_list()
-        self._lock.release()
+        with self._lock:
+            res = self.deck_word.loc[self.deck_word['deck_id'] == deck_id, 'word_id'].to_list()
         return res
 
     def get_user_decks(self, chat_id: int, lang: str):
-        self._lock.acquire()
-        res = self.decks.loc[(self.decks['owner'] == str(chat_id)) & (self.decks['language'] == lang)]['id'].to_list()
-        self._lock.release()
+        with self._lock:
+            res = self.decks.loc[(self.decks['owner'] == str(chat_id)) & (self.decks['language'] == lang)]['id'].to_list()
         return res
 
     def get_custom_deck_id(self, chat_id, lang):
-        self._lock.acquire()
-        if len(self.decks.loc[(self.decks['owner'] == str(chat_id)) & (self.decks['language'] == lang) & (self.decks['name'] == 'custom'), 'id']) == 0:
-            self._lock.release()
-            return None
-        res = self.decks.loc[(self.decks['owner'] == str(chat_id)) & (self.decks['language'] == lang) & (self.decks['name'] == 'custom'), 'id'].item()
-        self._lock.release()
+        with self._lock:
+            if len(self.decks.loc[(self.decks['owner'] == str(chat_id)) & (self.decks['language'] == lang) & (self.decks['name'] == 'custom'), 'id']) == 0:
+                return None
+            res = self.decks.loc[(self.decks['owner'] == str(chat_id)) & (self.decks['language'] == lang) & (self.decks['name'] == 'custom'), 'id'].item()
         return res
 
     def add_custom_deck(self, chat_id: str, lang: str):
-        self._lock.acquire()
-        new_deck_id = len(self.decks)
-        self.decks.loc[new_deck_id] = \
-            dict(id=len(self.decks), owner=chat_id, name='custom', language=lang, tags=np.nan)
-        self._lock.release()
+        with self._lock:
+            new_deck_id = len(self.decks)
+            new_deck = dict(id=new_deck_id, owner=chat_id, name='custom', language=lang, tags=np.nan)
+            self.decks.loc[new_deck_id] = new_deck
+            self._deck_index[new_deck_id] = new_deck_id
+            self.version += 1
+            self._decks_snapshot = self.decks.copy(deep=False)
+            self.storage.insert('decks', new_deck)
         return new_deck_id
 
     def save_decks_db(self):
-        self._lock.acquire()
-        self.decks.to_csv(self.decks_path, index=False)
-        self.deck_word.to_csv(self.deck_word_db_path, index=False)
-        self._lock.release()
+        with self._lock:
+            self.storage.commit('decks', self.decks)
+            self.storage.commit('deck_word', self.deck_word)
 
     def add_new_word(self, deck_id: int, word_id: int):
-        self._lock.acquire()
-        self.deck_word.loc[len(self.deck_word)] = \
-            dict(deck_id=deck_id, word_id=word_id)
-        self._lock.release()
-
-    def release_lock(self):
-        if self._lock.locked():
-            self._lock.release()
+        self.add_new_words(deck_id, [word_id])
 
+    def add_new_words(self, deck_id: int, word_ids: list):
+        # adds all words to the deck with a single change of deck_word
+        if len(word_ids) == 0:
+            return
+        with self._lock:
+            new_links = [dict(deck_id=deck_id, word_id=word_id) for word_id in word_ids]
+            labels = range(len(self.deck_word), len(self.deck_word) + len(new_links))
+            self.deck_word = pd.concat([self.deck_word, pd.DataFrame(new_links, index=labels)])
+            for new_link in new_links:
+                self.storage.insert('deck_word', new_link)
+            self.version += 1
+            self._deck_word_snapshot = self.deck_word.copy(deep=False)
+        for word_id in word_ids:
+            for callback in self._listeners:
+                callback(deck_id, word_id)
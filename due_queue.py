@@ -0,0 +1,81 @@
+import heapq
+import itertools
+from datetime import date
+from typing import List, Optional
+
+import pandas as pd
+
+
+class DueQueue:
+    """Words of one user ordered by the next review date.
+
+    Mirrors the order of sorting the user's progress by next_review_date: words with a review date come first,
+    words without one come last and are always due. Entries are replaced lazily, stale heap items are dropped
+    when they reach the top.
+    """
+
+    def __init__(self, max_n_reps):
+        self.max_n_reps = max_n_reps
+        self._entries = dict()  # word_id -> (version, word, next_review_date, num_reps)
+        self._seq = itertools.count()
+        self._dated_all = []
+        self._dated_eligible = []  # words with num_reps < max_n_reps
+        self._undated_all = dict()  # insertion-ordered sets of word_ids
+        self._undated_eligible = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, word_id):
+        return word_id in self._entries
+
+    def update(self, word_id: int, word: str, next_review_date: Optional[date], num_reps: float) -> None:
+        self.remove(word_id)
+        version = next(self._seq)
+        next_review_date = None if pd.isna(next_review_date) else next_review_date
+        self._entries[word_id] = (version, word, next_review_date, num_reps)
+        eligible = num_reps < self.max_n_reps
+        if next_review_date is None:
+            self._undated_all[word_id] = None
+            if eligible:
+                self._undated_eligible[word_id] = None
+        else:
+            heapq.heappush(self._dated_all, (next_review_date, version, word_id))
+            if eligible:
+                heapq.heappush(self._dated_eligible, (next_review_date, version, word_id))
+
+    def remove(self, word_id: int) -> None:
+        # heap items of the removed entry become stale and are skipped by _peek
+        if self._entries.pop(word_id, None) is not None:
+            self._undated_all.pop(word_id, None)
+            self._undated_eligible.pop(word_id, None)
+
+    def _peek(self, heap):
+        while len(heap) > 0:
+            next_review_date, version, word_id = heap[0]
+            entry = self._entries.get(word_id)
+            if entry is not None and entry[0] == version:
+                return word_id, next_review_date
+            heapq.heappop(heap)
+        return None, None
+
+    def next_word(self, today: date) -> Optional[tuple[int, str]]:
+        """Returns (word_id, word) of the earliest due word or the earliest word overall if nothing is due."""
+        if len(self._entries) == 0:
+            return None
+
+        word_id, next_review_date = self._peek(self._dated_eligible)
+        if word_id is None or next_review_date > today:
+            word_id = next(iter(self._undated_eligible), None)
+        if word_id is None:
+            word_id, _ = self._peek(self._dated_all)
+        if word_id is None:
+            word_id = next(iter(self._undated_all))
+        return word_id, self._entries[word_id][1]
+
+    def due(self, today: date) -> List[tuple[int, str]]:
+        """Returns (word_id, word) of all due words in the order they will be tested."""
+        due_entries = [(entry[2] is None, entry[2], entry[0], word_id, entry[1]) for word_id, entry in self._entries.items()
+                       if entry[3] < self.max_n_reps and (entry[2] is None or entry[2] <= today)]
+        due_entries.sort(key=lambda e: (e[0], e[1] if e[1] is not None else date.min, e[2]))
+        return [(e[3], e[4]) for e in due_entries]
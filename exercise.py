@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Callable, Optional
 import uuid
 
 
@@ -7,5 +7,7 @@ class Exercise:
     def __init__(self):
         self.uid = str(uuid.uuid1())
 
-    async def get_next_user_message(self, user_response: Optional[str]) -> tuple[str, int]:
+    async def get_next_user_message(self, user_response: Optional[str],
+                                    on_partial: Optional[Callable[[str], None]] = None) -> tuple[str, int]:
+        # on_partial is called with the beginning of the message while the message is being generated
         pass
\ No newline at end of file
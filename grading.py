@@ -0,0 +1,76 @@
+import re
+import unicodedata
+from typing import Optional
+
+
+# combining acute and grave accents, they mark stress or vowel quality, e.g. in 'café' or 'más', or the stress of a
+# Cyrillic word. Other marks tell letters apart, e.g. 'ñ', 'й' or 'ё', and are kept.
+_ACCENTS = {'\u0300', '\u0301', '\u0340', '\u0341'}
+
+
+def _is_cyrillic(ch):
+    return '\u0400' <= ch <= '\u04ff'
+
+
+def normalize(text: str, strip_accents=True) -> str:
+    """Lowercases text, removes punctuation, invisible characters, acute and grave accents and repeated whitespace.
+
+    Stress marks on Cyrillic letters are optional in writing and are always removed.
+    """
+    text = unicodedata.normalize('NFD', text)
+    chars = []
+    base = ''
+    for ch in text:
+        category = unicodedata.category(ch)
+        if ch in _ACCENTS and (strip_accents or _is_cyrillic(base)):
+            continue
+        if category == 'Cf':
+            continue
+        if not category.startswith('M'):
+            base = ch
+        chars.append(' ' if category.startswith('P') else ch)
+    text = unicodedata.normalize('NFC', ''.join(chars)).casefold()
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Levenshtein distance of a and b, any distance above max_distance is returned as max_distance + 1."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, start=1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+        if min(cur) > max_distance:
+            return max_distance + 1
+        prev = cur
+    return min(prev[-1], max_distance + 1)
+
+
+def grade_flashcard(user_response: str, correct_answer: str) -> Optional[tuple[int, str]]:
+    """Grades clear-cut answers to a flashcard without the assistant.
+
+    Returns (score, key of the justification in interface.json) or None if the answer has to be graded by the
+    assistant, e.g. a synonym or a different form of the word.
+    """
+    answer = normalize(user_response, strip_accents=False)
+    correct = normalize(correct_answer, strip_accents=False)
+    if not any(ch.isalnum() for ch in answer):
+        return 1, 'No answer was given'
+    if answer == correct:
+        return 5, 'The answer is correct'
+
+    answer = normalize(user_response)
+    correct = normalize(correct_answer)
+    if answer == correct:
+        return 4, 'The answer is correct, but the accents are wrong'
+
+    # one typo per 6 letters is tolerated, short words must be exact. A typo at the end of the word may be a
+    # different form of the word, it is scored lower.
+    max_typos = len(correct) // 6
+    if max_typos > 0 and edit_distance(answer, correct, max_typos) <= max_typos:
+        if answer[-2:] == correct[-2:]:
+            return 4, 'The answer is correct, but has a typo'
+        return 3, 'The answer is almost correct, but the ending is wrong'
+    return None
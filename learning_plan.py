@@ -1,21 +1,36 @@
 import math
-from datetime import datetime, timedelta
+import random
+from datetime import date, datetime, timedelta
 from dataclasses import dataclass
+import logging
 import os
 from typing import Dict, List, Optional
-import jinja2
 import numpy as np
 import pandas as pd
 from pydantic import BaseModel, Field
 
+from daily_counters import DailyActivityCounters
 from exercise import Exercise
 from item import Item
-from utils import get_assistant_response
+from user_vocabulary import UserVocabulary
+from utils import get_assistant_response, get_response_format
 from words_exercise import FlashcardExercise, WordsExerciseLearn, WordsExerciseTest
 
 
+logger = logging.getLogger(__name__)
+
+
+class NewWordsSchema(BaseModel):
+    class Config:
+        extra = 'forbid'
+
+    deck_theme: str
+    deck_words: list[str]
+
+
 class LearningPlan:
-    def __init__(self, interface, templates, words_progress_db=None, words_db=None, decks_db=None, user_config=None):
+    def __init__(self, interface, templates, words_progress_db=None, words_db=None, decks_db=None, user_config=None,
+                 clock=datetime.now):
         self.progress_db = words_progress_db
         self.words_db = words_db
         self.decks_db = decks_db
@@ -23,6 +38,76 @@ class LearningPlan:
         self.interface = interface
         self.templates = templates
         self.max_n_reps = 10  # a word will not be tested more than this many times
+        self.clock = clock  # returns the current naive local time, replaced by a fake clock in simulations
+
+        # chat_id -> lang -> UserVocabulary
+        self._vocabularies = dict()
+        self.daily_counters = DailyActivityCounters(self.user_config, clock=self.clock)
+        self._long_due_reset = set()  # (chat_id, lang) whose words were reset by the last reset_long_due_words
+        if self.progress_db is not None:
+            self.daily_counters.rebuild(self.progress_db.get_progress_df())
+            self.progress_db.add_listener(self._on_progress_change)
+        if self.decks_db is not None:
+            self.decks_db.add_listener(self._on_deck_word_added)
+
+    def _get_vocabulary(self, chat_id, lang) -> UserVocabulary:
+        chat_vocabularies = self._vocabularies.setdefault(chat_id, dict())
+        if lang in chat_vocabularies:
+            return chat_vocabularies[lang]
+
+        vocabulary = UserVocabulary(chat_id, lang, self.max_n_reps)
+
+        words_df = self.words_db.get_words_df()
+        lang_words_df = words_df[words_df['lang'] == lang.lower()]
+        deck_words_df = self.decks_db.get_deck_word_df()
+        user_decks = self.decks_db.get_user_decks(chat_id, lang)
+        deck_words_df = deck_words_df[deck_words_df['deck_id'].isin(user_decks)]
+        vocabulary.n_deck_links = deck_words_df.shape[0]
+        lang_deck_words_df = lang_words_df[lang_words_df['id'].isin(deck_words_df['word_id'])]
+        meanings = lang_deck_words_df['meaning'] if 'meaning' in lang_deck_words_df.columns else [None] * lang_deck_words_df.shape[0]
+        for word_id, word, meaning in zip(lang_deck_words_df['id'], lang_deck_words_df['word'], meanings):
+            vocabulary.deck_words[int(word_id)] = (word, meaning)
+
+        progress_df = self.progress_db.get_progress_df()
+        progress_df = progress_df[progress_df['chat_id'] == chat_id]
+        progress_df = pd.merge(progress_df, lang_words_df[['id', 'word']], how='inner', left_on='word_id', right_on='id', sort=False)
+        progress_cols = ['num_reps', 'e_factor', 'last_interval', 'last_review_date', 'next_review_date', 'to_ignore']
+        for row in progress_df[['word_id', 'word'] + progress_cols].itertuples(index=False):
+            vocabulary.set_progress(int(row.word_id), row.word, {c: getattr(row, c) for c in progress_cols})
+
+        chat_vocabularies[lang] = vocabulary
+        return vocabulary
+
+    def _on_progress_change(self, chat_id, word_id, progress) -> None:
+        self.daily_counters.update(chat_id, word_id, progress)
+        if chat_id not in self._vocabularies:
+            return
+        word_data = self.words_db.get_word_by_id(word_id)
+        if word_data is None:
+            return
+        for vocabulary in self._vocabularies[chat_id].values():
+            if vocabulary.lang.lower() == word_data['lang']:
+                vocabulary.set_progress(word_id, word_data['word'], progress)
+
+    def _on_deck_word_added(self, deck_id, word_id) -> None:
+        deck = self.decks_db.get_deck(deck_id)
+        if deck is None:
+            return
+        try:
+            # group chats have negative ids, decks that are not owned by a chat are skipped
+            owner = int(deck['owner'])
+        except (TypeError, ValueError):
+            return
+        if owner not in self._vocabularies:
+            return
+        vocabulary = self._vocabularies[owner].get(deck['language'])
+        if vocabulary is None:
+            return
+        word_data = self.words_db.get_word_by_id(word_id)
+        if word_data is None or word_data['lang'] != vocabulary.lang.lower():
+            vocabulary.add_deck_word(word_id, None, None)
+        else:
+            vocabulary.add_deck_word(word_id, word_data['word'], word_data.get('meaning'))
     
     def calculate_interval(self, item: Item) -> int:
         """Returns number of days until the next review."""
@@ -42,42 +127,50 @@ class LearningPlan:
         if not self.has_enough_words(chat_id, lang):
             await self.add_words(chat_id, lang)
 
-        now = datetime.now().date()
+        now = self.clock().date()
 
-        words_df = self.words_db.get_words_df()
-        deck_words_df = self.decks_db.get_deck_word_df()
+        vocabulary = self._get_vocabulary(chat_id, lang)
+        if vocabulary.n_deck_links == 0:
+            return None
 
-        deck_words_df = pd.merge(words_df, deck_words_df, how='inner', left_on='id', right_on='word_id', sort=False)
-        user_decks = self.decks_db.get_user_decks(chat_id, lang)
-        deck_words_df = deck_words_df[deck_words_df['deck_id'].isin(user_decks)]
+        # progress on words that are long due is reset by reset_long_due_words
+        long_due_reset = (chat_id, lang) in self._long_due_reset
+        self._long_due_reset.discard((chat_id, lang))
 
-        if deck_words_df.shape[0] == 0:
-            return None
+        mode = self._resolve_mode(chat_id, mode, long_due_reset)
 
-        progress_df = self.progress_db.get_progress_df()
-        last_review_date = pd.to_datetime(progress_df['last_review_date']).dt.date
-        n_done_today = progress_df.loc[(progress_df['chat_id'] == chat_id) & (last_review_date == now)].shape[0]
-        n_tests_done_today = progress_df.loc[(progress_df['chat_id'] == chat_id) & (last_review_date == now) & (progress_df['num_reps'] > 0)].shape[0]
+        meaning = None
+        num_reps = math.nan
+        if mode in ['test_flashcard', 'test_translation']:
+            next_word = vocabulary.due_queue.next_word(now)
+            if next_word is None:
+                return None
+            word_id, word = next_word
+        else:
+            unseen_words, candidate_words = vocabulary.learn_candidates()
+            if len(candidate_words) == 0:
+                return None
+
+            word_id = random.choice(unseen_words) if len(unseen_words) > 0 else random.choice(candidate_words)
+            word, meaning = vocabulary.deck_words[word_id]
+            num_reps = vocabulary.progress[word_id]['num_reps'] if word_id in vocabulary.progress else math.nan
+
+        return self._make_exercise(chat_id, lang, mode, word, word_id, meaning, num_reps)
+
+    def _resolve_mode(self, chat_id, mode, long_due_reset, n_tests_ahead=0) -> str:
+        # n_tests_ahead predicts the mode of a later exercise, assuming that many tests are done before it
+        n_done_today = self.daily_counters.n_done_today(chat_id) + n_tests_ahead
+        n_tests_done_today = self.daily_counters.n_tests_done_today(chat_id) + n_tests_ahead
         user_data = self.user_config.get_user_data(chat_id)
         n_flashcards = user_data.get('n_flashcards', 5)
 
-        # reset progress on words that are long due
-        words_progress = pd.merge(progress_df, deck_words_df, how='left', left_on='word_id', right_on='word_id', sort=False)
-        user_not_ignored_mask = ((words_progress['lang'] == lang.lower()) & (words_progress['chat_id'] == chat_id) & words_progress['to_ignore'].isin([False, np.nan]))
-        long_due_today_mask = user_not_ignored_mask & ((words_progress['next_review_date'] <= now - timedelta(days=5)) | words_progress['next_review_date'].isna()) & (words_progress['num_reps'] < self.max_n_reps)
-        long_due_words = words_progress[long_due_today_mask]['word_id'].to_list()
-        if len(long_due_words) > 0:
-            self.progress_db.remove_progress(chat_id, long_due_words)
-        self.progress_db.save_progress()
-        progress_df = self.progress_db.get_progress_df()
-
-        if mode == 'learn' and len(long_due_words) > 0:
+        if mode == 'learn' and long_due_reset:
             mode = 'test_flashcard'
 
         if mode is None:
-            if n_done_today == 0 and len(long_due_words) == 0:
+            if n_done_today == 0 and not long_due_reset:
                 mode  = 'learn'
-            elif n_done_today == 0 and len(long_due_words) > 0:
+            elif n_done_today == 0 and long_due_reset:
                 mode  = 'test_flashcard'
             elif n_tests_done_today % n_flashcards == 0:
                 mode = 'test_translation'
@@ -86,101 +179,133 @@ class LearningPlan:
 
         if mode == 'test':
             mode = 'test_translation' if (n_tests_done_today > 0) and (n_tests_done_today % n_flashcards == 0) else 'test_flashcard'
+        return mode
 
-        if mode in ['test_flashcard', 'test_translation']:
-            progress_df = progress_df[progress_df['to_ignore'].isin([False, np.nan])]
-            words_progress = pd.merge(progress_df, deck_words_df, how='left', left_on='word_id', right_on='word_id', sort=False)
-            user_words_progress = words_progress.loc[(words_progress['lang'] == lang.lower()) & (words_progress['chat_id'] == chat_id)]
-
-            if user_words_progress.shape[0] == 0:
-                return None
-            
-            user_words_progress = user_words_progress.sort_values(by='next_review_date')
-            to_review_mask = (((user_words_progress['next_review_date'] <= now) | user_words_progress['next_review_date'].isna()) & (user_words_progress['num_reps'] < self.max_n_reps))
-            if to_review_mask.sum() > 0:
-                to_review_words = user_words_progress[to_review_mask]
-                row_item = to_review_words.iloc[0]
-            else:
-                row_item = user_words_progress.iloc[0]
-        else:
-
-            user_words_progress = pd.merge(progress_df, deck_words_df, how='right', left_on='word_id', right_on='id', sort=False)
-            user_words_progress = user_words_progress[user_words_progress['to_ignore'].isin([False, np.nan])]
-
-            if user_words_progress.shape[0] == 0:
-                return None
-
-            unseen_words = user_words_progress[user_words_progress['next_review_date'].isna()]
-
-            if unseen_words.shape[0] > 0:
-                row_item = unseen_words.sample(n=1).iloc[0]
-            else:
-                user_words_progress = user_words_progress.sort_values(by=['next_review_date', 'num_reps'])
-                row_item = user_words_progress.sample(n=1).iloc[0]
-
+    def _make_exercise(self, chat_id, lang, mode, word, word_id, meaning=None, num_reps=math.nan) -> Exercise:
         user_level = self.user_config.get_user_data(chat_id)['level']
         uilang = self.user_config.get_user_ui_lang(chat_id)
                 
         if 'test_flashcard' == mode:
-            exercise = FlashcardExercise(word=row_item['word'], word_id=row_item['id'].item(), lang=lang, uilang=uilang, level=user_level,
+            exercise = FlashcardExercise(word=word, word_id=word_id, lang=lang, uilang=uilang, level=user_level,
                                          interface=self.interface, templates=self.templates)
         elif 'test_translation' == mode:
-            exercise = WordsExerciseTest(word=row_item['word'], word_id=row_item['id'].item(), lang=lang, uilang=uilang, level=user_level,
+            exercise = WordsExerciseTest(word=word, word_id=word_id, lang=lang, uilang=uilang, level=user_level,
                                          interface=self.interface, templates=self.templates)
         else:
-            exercise = WordsExerciseLearn(word=row_item['word'], meaning=row_item['meaning'], word_id=row_item['id'].item(), lang=lang, uilang=uilang,
-                                          num_reps=row_item['num_reps'].item(), interface=self.interface,
+            exercise = WordsExerciseLearn(word=word, meaning=meaning, word_id=word_id, lang=lang, uilang=uilang,
+                                          num_reps=num_reps, interface=self.interface,
                                           templates=self.templates)
 
         return exercise
 
-    def get_due_today(self, chat_id: str, lang: str) -> List[str]:
-
-        now = datetime.now().date()
-
-        words_df = self.words_db.get_words_df()
-        deck_words_df = self.decks_db.get_deck_word_df()
+    def get_upcoming_tests(self, chat_id, lang, mode='test', n=2) -> List[Exercise]:
+        """Returns the next n test exercises the user is likely to get, without changing any state.
+
+        The words follow the due list and the modes assume that the tests before are answered. Learn exercises
+        are picked at random, so they are never predicted.
+        """
+        now = self.clock().date()
+        vocabulary = self._get_vocabulary(chat_id, lang)
+        if vocabulary.n_deck_links == 0:
+            return []
+
+        words = vocabulary.due_queue.due(now)[:n]
+        if len(words) == 0:
+            next_word = vocabulary.due_queue.next_word(now)
+            words = [] if next_word is None else [next_word]
+
+        long_due_reset = (chat_id, lang) in self._long_due_reset
+        exercises = []
+        for n_tests_ahead, (word_id, word) in enumerate(words):
+            word_mode = self._resolve_mode(chat_id, mode, long_due_reset, n_tests_ahead)
+            if word_mode not in ['test_flashcard', 'test_translation']:
+                break
+            exercises.append(self._make_exercise(chat_id, lang, word_mode, word, word_id))
+        return exercises
 
-        deck_words_df = pd.merge(words_df, deck_words_df, how='inner', left_on='id', right_on='word_id', sort=False)
-        user_decks = self.decks_db.get_user_decks(chat_id, lang)
-        deck_words_df = deck_words_df[deck_words_df['deck_id'].isin(user_decks)]
+    def _long_due_mask(self, progress_df, cutoff):
+        # cutoff is a date or a Series of dates aligned with progress_df
+        return (progress_df['to_ignore'].isin([False, np.nan]) & (progress_df['num_reps'] < self.max_n_reps) &
+                ((progress_df['next_review_date'] <= cutoff) | progress_df['next_review_date'].isna()))
 
-        if deck_words_df.shape[0] == 0:
-            return None
+    def find_long_due_words(self, local_dates: Optional[Dict[int, date]] = None) -> pd.DataFrame:
+        """Returns chat_id, word_id, language and cutoff of the deck words that are due for 5 days or more.
 
+        local_dates maps the chat ids of the users to check to their local dates, all users are checked on the date
+        of the clock if it is None. Only snapshots of the databases are read, so it can run in a worker thread.
+        """
         progress_df = self.progress_db.get_progress_df()
+        if local_dates is None:
+            cutoff = self.clock().date() - timedelta(days=5)
+        else:
+            progress_df = progress_df[progress_df['chat_id'].isin(list(local_dates.keys()))]
+            cutoff = progress_df['chat_id'].map({chat_id: local_date - timedelta(days=5) for chat_id, local_date in local_dates.items()})
+        long_due_df = progress_df.loc[self._long_due_mask(progress_df, cutoff), ['chat_id', 'word_id']]
+        long_due_df['cutoff'] = cutoff if local_dates is None else cutoff.loc[long_due_df.index]
+
+        # only words in the user's own decks of the word's language are reset
+        words_df = self.words_db.get_words_df()[['id', 'lang']]
+        decks_df = self.decks_db.get_decks_df()[['id', 'owner', 'language']]
+        long_due_df = pd.merge(long_due_df, words_df, how='inner', left_on='word_id', right_on='id', sort=False).drop(columns='id')
+        long_due_df = pd.merge(long_due_df, self.decks_db.get_deck_word_df(), how='inner', on='word_id', sort=False)
+        long_due_df = pd.merge(long_due_df, decks_df, how='inner', left_on='deck_id', right_on='id', sort=False)
+        long_due_df = long_due_df[(long_due_df['owner'] == long_due_df['chat_id'].astype(str)) &
+                                  (long_due_df['lang'] == long_due_df['language'].str.lower())]
+        return long_due_df[['chat_id', 'word_id', 'language', 'cutoff']].drop_duplicates(['chat_id', 'word_id'])
+
+    def reset_words(self, long_due_df: pd.DataFrame) -> int:
+        """Resets progress on the words found by find_long_due_words that are still long due, returns their number."""
+        keys = list(zip(long_due_df['chat_id'].astype(int), long_due_df['word_id'].astype(int)))
+        # the words may have been reviewed since they were found
+        progress_df = self.progress_db.get_progress_batch(keys)
+        progress_df = pd.merge(progress_df, long_due_df[['chat_id', 'word_id', 'cutoff']], how='inner', on=['chat_id', 'word_id'], sort=False)
+        progress_df = progress_df[self._long_due_mask(progress_df, progress_df['cutoff'])]
+        keys = list(zip(progress_df['chat_id'].astype(int), progress_df['word_id'].astype(int)))
+        if len(keys) > 0:
+            self.progress_db.remove_progress_batch(keys)
+            self.progress_db.save_progress()
+
+        reset_keys = set(keys)
+        reset_users = {(chat_id, lang) for chat_id, word_id, lang in
+                       zip(long_due_df['chat_id'].astype(int), long_due_df['word_id'].astype(int), long_due_df['language'])
+                       if (chat_id, word_id) in reset_keys}
+        # users whose flag from an earlier reset was not consumed yet keep it
+        self._long_due_reset |= reset_users
+        logger.info(f'Reset progress on {len(keys)} long due words of {len(reset_users)} users')
+        return len(keys)
+
+    def reset_long_due_words(self, local_dates: Optional[Dict[int, date]] = None) -> int:
+        """Resets progress on deck words that are due for 5 days or more, returns the number of reset words.
+
+        See find_long_due_words for local_dates.
+        """
+        return self.reset_words(self.find_long_due_words(local_dates))
 
-        progress_df = progress_df[progress_df['to_ignore'].isin([False, np.nan])]
-        words_progress = pd.merge(progress_df, deck_words_df, how='left', left_on='word_id', right_on='word_id', sort=False)
-        user_words_progress = words_progress.loc[(words_progress['lang'] == lang.lower()) & (words_progress['chat_id'] == chat_id)]
+    def get_due_today(self, chat_id: str, lang: str) -> List[str]:
 
-        if user_words_progress.shape[0] == 0:
+        now = self.clock().date()
+
+        due_queue = self._get_vocabulary(chat_id, lang).due_queue
+        if len(due_queue) == 0:
             return None
-    
-        user_words_progress = user_words_progress.sort_values(by='next_review_date')
-        to_review_mask = (((user_words_progress['next_review_date'] <= now) | user_words_progress['next_review_date'].isna()) & (user_words_progress['num_reps'] < self.max_n_reps))
-        if to_review_mask.sum() > 0:
-            to_review_words = user_words_progress[to_review_mask]['word'].to_list()
-        else:
-            to_review_words = []
 
-        return to_review_words
+        return [word for _, word in due_queue.due(now)]
 
 
     def process_hint(self, chat_id: int, exercise: Exercise) -> None:
         item = self.progress_db.get_word_progress(chat_id, exercise.word_id)
         item.num_reps = 1
         item.last_interval = max(math.floor(item.last_interval / 2), 0)
-        item.last_review_date = datetime.now()
-        item.next_review_date = (datetime.now() + timedelta(days=1)).date()
+        item.last_review_date = self.clock()
+        item.next_review_date = (self.clock() + timedelta(days=1)).date()
         self.progress_db.set_word_progress(chat_id, exercise.word_id, item)
 
     def process_correct_answer(self, chat_id: int, exercise: Exercise) -> None:
         item = self.progress_db.get_word_progress(chat_id, exercise.word_id)
         item.num_reps = 1
         item.last_interval = 0
-        item.last_review_date = datetime.now()
-        item.next_review_date = (datetime.now() + timedelta(days=1)).date()
+        item.last_review_date = self.clock()
+        item.next_review_date = (self.clock() + timedelta(days=1)).date()
         self.progress_db.set_word_progress(chat_id, exercise.word_id, item)
 
     def process_response(self, chat_id: int, exercise: Exercise, quality: Optional[int]) -> None:
@@ -192,7 +317,7 @@ class LearningPlan:
             if item is None:
                 self.progress_db.add_word_to_progress(chat_id, exercise.word_id)
             item = self.progress_db.get_word_progress(chat_id, exercise.word_id)
-            now = datetime.now()
+            now = self.clock()
             item.last_review_date = now
             item.next_review_date = (now + timedelta(days=1)).date()
         elif quality is not None:
@@ -215,12 +340,65 @@ class LearningPlan:
             
             new_interval = self.calculate_interval(item)
             item.last_interval += new_interval
-            now = datetime.now()
+            now = self.clock()
             item.last_review_date = now
             item.next_review_date = (now + timedelta(days=new_interval)).date()
 
         self.progress_db.set_word_progress(chat_id, exercise.word_id, item)
 
+    def process_responses_batch(self, chat_ids, word_ids, qualities, timestamps) -> int:
+        """Applies many test results at once, e.g. when importing a review history.
+
+        Computes the same updates as process_response for every (chat_id, word_id, quality, timestamp), reviews of
+        the same word are applied in the order of their timestamps. Words without progress start from a new Item.
+        All changes are written to the progress db at once. Returns the number of updated words.
+        """
+        events = pd.DataFrame(dict(chat_id=np.asarray(chat_ids, dtype=np.int64), word_id=np.asarray(word_ids, dtype=np.int64),
+                                   quality=np.asarray(qualities, dtype=np.int64), timestamp=pd.to_datetime(timestamps)))
+        if events.shape[0] == 0:
+            return 0
+        if ((events['quality'] < 0) | (events['quality'] > 5)).any():
+            raise ValueError("Quality must be between 0 and 5")
+        events = events.sort_values('timestamp', kind='stable')
+
+        state = events[['chat_id', 'word_id']].drop_duplicates().reset_index(drop=True)
+        item = Item()
+        existing = self.progress_db.get_progress_batch(list(zip(state['chat_id'], state['word_id'])))
+        state = pd.merge(state, existing[['chat_id', 'word_id', 'num_reps', 'e_factor', 'last_interval']],
+                         how='left', on=['chat_id', 'word_id'], sort=False)
+        e_factor = state['e_factor'].fillna(item.e_factor).to_numpy(dtype=float, copy=True)
+        num_reps = state['num_reps'].fillna(item.num_reps).to_numpy(dtype=float, copy=True)
+        last_interval = state['last_interval'].fillna(item.last_interval).to_numpy(dtype=float, copy=True)
+        last_review_date = np.empty(state.shape[0], dtype='datetime64[ns]')
+        interval = np.zeros(state.shape[0], dtype=float)
+
+        state['pos'] = np.arange(state.shape[0])
+        events = pd.merge(events, state[['chat_id', 'word_id', 'pos']], how='left', on=['chat_id', 'word_id'], sort=False)
+        # the n-th review of every word is applied in round n, so that a word appears at most once per round
+        events['round'] = events.groupby('pos').cumcount()
+        for _, round_events in events.groupby('round', sort=True):
+            pos = round_events['pos'].to_numpy()
+            quality = round_events['quality'].to_numpy()
+
+            e_factor[pos] = np.maximum(1.3, e_factor[pos] + (0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02)))
+            failed = quality < 3
+            num_reps[pos] = np.where(failed, 1, num_reps[pos] + 1)
+            prev_interval = np.where(failed, 0, last_interval[pos])
+            interval[pos] = np.where(np.isin(prev_interval, [0, 1]), 1,
+                                     np.where(prev_interval == 2, 6, np.ceil(prev_interval * e_factor[pos])))
+            last_interval[pos] = prev_interval + interval[pos]
+            last_review_date[pos] = round_events['timestamp'].to_numpy(dtype='datetime64[ns]')
+
+        last_review_date = pd.Series(last_review_date)
+        state['e_factor'] = e_factor
+        state['num_reps'] = num_reps
+        state['last_interval'] = last_interval.astype(int)
+        state['last_review_date'] = last_review_date
+        state['next_review_date'] = (last_review_date + pd.to_timedelta(interval, unit='D')).dt.date
+        self.progress_db.set_progress_batch(state.drop(columns='pos'))
+        self.progress_db.save_progress()
+        return state.shape[0]
+
     # def set_word_easy(self, chat_id: int, word_id: int) -> None:
     #     item = self.progress_db.get_word_progress(chat_id, word_id)
     #     if item is None:
@@ -231,20 +409,8 @@ class LearningPlan:
     #     self.progress_db.set_word_progress(chat_id, word_id, item)
 
     def has_enough_words(self, chat_id, lang):
-        progress_df = self.progress_db.get_progress_df()
-
-        words_df = self.words_db.get_words_df()
-        words_lang = words_df[words_df['lang'] == lang]
-
-        all_seen_words = progress_df.loc[(progress_df['chat_id'] == chat_id)]
-        lang_seen_words = pd.merge(all_seen_words, words_lang, how='inner', left_on='word_id', right_on='id', sort=False)
-
-        user_decks = self.decks_db.get_user_decks(chat_id, lang)
-        user_words = []
-        for deck in user_decks:
-            deck_words = self.decks_db.get_deck_words(deck)
-            user_words += deck_words
-        return lang_seen_words.shape[0] < len(user_words)
+        vocabulary = self._get_vocabulary(chat_id, lang)
+        return len(vocabulary.progress) < vocabulary.n_deck_links
 
     async def add_words(self, chat_id, lang):
 
@@ -256,41 +422,21 @@ class LearningPlan:
         if words_df.shape[0] == 0:
             return None
 
-        progress_df = self.progress_db.get_progress_df()
-        progress_words_df = pd.merge(progress_df, words_df, how='outer', left_on='word_id',
-                                     right_on='id', sort=False)
-        not_ignored_words = progress_words_df.loc[(progress_words_df['lang'] == lang.lower()) & (progress_words_df['chat_id'] == chat_id) &
-                                                  progress_words_df['to_ignore'].isin([False, np.nan])]
+        not_ignored_words = self._get_vocabulary(chat_id, lang).known_words()
 
-        if not_ignored_words.shape[0] > 0:
-            user_words_str = ', '.join(not_ignored_words['word'].to_list())
+        if len(not_ignored_words) > 0:
+            user_words_str = ', '.join(not_ignored_words)
         else:
             user_words_str = 'No words learned yet.'
 
-        message_template = self.templates.get_template(uilang, lang, 'gen_words')
-        template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+        template = self.templates.get_template(uilang, lang, 'gen_words')
         query = template.render(lang=lang, user_words_str=user_words_str)
 
         model_base = os.getenv('MODEL_BASE')
         model_substitute = os.getenv('MODEL_SUBSTITUTE')
 
-        class NewWordsSchema(BaseModel):
-            class Config:
-                extra = 'forbid'
-
-            deck_theme: str
-            deck_words: list[str]
-
         validation_cls = NewWordsSchema
-        schema = validation_cls.model_json_schema()
-
-        response_format = {
-            "type": "json_schema",
-            "json_schema": {"strict": True,
-                            "name": "new_words",
-                            "schema": schema
-                            }
-        }
+        response_format = get_response_format(validation_cls, name='new_words')
 
         for i in range(3):
             assistant_response = await get_assistant_response(self.interface, query, model_base=model_base,
@@ -306,8 +452,7 @@ class LearningPlan:
         if custom_deck_id is None:
             custom_deck_id = self.decks_db.add_custom_deck(str(chat_id), lang)
 
-        for word in new_words:
-            word_id = self.words_db.add_new_word(word, lang)
-            self.decks_db.add_new_word(custom_deck_id, word_id)
+        word_ids = self.words_db.add_new_words(new_words, lang)
+        self.decks_db.add_new_words(custom_deck_id, word_ids)
         self.words_db.save_words_db()
         self.decks_db.save_decks_db()
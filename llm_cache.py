@@ -0,0 +1,121 @@
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ResponseCache:
+    """Two-tier cache of assistant responses keyed by the request content.
+
+    Every key keeps a pool of up to n_variants responses: while the pool is not full a lookup misses, so that new
+    variants get generated, afterwards a random variant is served. Recently used keys are kept in memory, all keys
+    are kept in a sqlite database. Variants expire after ttl seconds, the least recently used keys are evicted
+    when there are more than max_disk_keys of them.
+
+    Hits only update the recency of the key in memory, it is written to the database by the next put. Lookups
+    can read the database, so async code calls the cache in a worker thread.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS responses (key TEXT NOT NULL, created REAL NOT NULL, content TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS responses_key ON responses(key)',
+        'CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, last_used REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS keys_last_used ON keys(last_used)',
+    ]
+
+    def __init__(self, db_path, ttl=7 * 24 * 60 * 60, n_variants=3, max_memory_keys=1000, max_disk_keys=100000):
+        self.ttl = ttl
+        self.n_variants = n_variants
+        self.max_memory_keys = max_memory_keys
+        self.max_disk_keys = max_disk_keys
+        self._memory = OrderedDict()  # key -> list of (created, content), most recently used last
+        self._last_used = dict()  # key -> time of the last hit that is not written to the database yet
+        self._n_puts = 0
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def _variants(self, key, now):
+        # must be called with the lock held, returns unexpired variants and marks the key as recently used
+        variants = self._memory.get(key)
+        if variants is None:
+            rows = self._conn.execute('SELECT created, content FROM responses WHERE key = ? AND created > ?',
+                                      (key, now - self.ttl)).fetchall()
+            variants = [(created, content) for created, content in rows]
+            self._memory[key] = variants
+        else:
+            variants[:] = [(created, content) for created, content in variants if created > now - self.ttl]
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_keys:
+            self._memory.popitem(last=False)
+        return variants
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns a random cached variant or None if the pool of the key is not full yet."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            variants = self._variants(key, now)
+            if len(variants) < self.n_variants:
+                return None
+            self._last_used[key] = now
+            return random.choice(variants)[1]
+        finally:
+            self._lock.release()
+
+    def put(self, key: str, content: str) -> None:
+        now = time.time()
+        self._lock.acquire()
+        try:
+            variants = self._variants(key, now)
+            if len(variants) >= self.n_variants:
+                return
+            variants.append((now, content))
+            self._conn.execute('INSERT INTO responses (key, created, content) VALUES (?, ?, ?)', (key, now, content))
+            self._conn.execute('INSERT OR REPLACE INTO keys (key, last_used) VALUES (?, ?)', (key, now))
+            self._last_used.pop(key, None)
+            self._write_last_used()
+            self._n_puts += 1
+            if self._n_puts % 100 == 0:
+                self._evict(now)
+            self._conn.commit()
+        finally:
+            self._lock.release()
+
+    def _write_last_used(self):
+        # must be called with the lock held, the changes are committed by the caller
+        self._conn.executemany('UPDATE keys SET last_used = ? WHERE key = ?',
+                               [(last_used, key) for key, last_used in self._last_used.items()])
+        self._last_used.clear()
+
+    def _evict(self, now):
+        # must be called with the lock held
+        self._conn.execute('DELETE FROM responses WHERE created <= ?', (now - self.ttl,))
+        n_keys = self._conn.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+        if n_keys > self.max_disk_keys:
+            evicted = [row[0] for row in self._conn.execute('SELECT key FROM keys ORDER BY last_used LIMIT ?',
+                                                             (n_keys - self.max_disk_keys,)).fetchall()]
+            self._conn.executemany('DELETE FROM responses WHERE key = ?', [(key,) for key in evicted])
+            self._conn.executemany('DELETE FROM keys WHERE key = ?', [(key,) for key in evicted])
+            for key in evicted:
+                self._memory.pop(key, None)
+
+    def close(self) -> None:
+        self._lock.acquire()
+        try:
+            self._write_last_used()
+            self._conn.commit()
+            self._conn.close()
+        finally:
+            self._lock.release()
@@ -0,0 +1,148 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import numpy as np
+
+
+INTERACTIVE = 0  # replies to a user who is waiting
+BACKGROUND = 1  # scheduled pings and prefetching, can be deferred
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+# priority of the assistant requests made by the current task, tasks inherit it from the task that created them
+llm_priority = contextvars.ContextVar('llm_priority', default=INTERACTIVE)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, n) -> float:
+        """Returns seconds until n tokens are available."""
+        self._refill()
+        return max(0.0, (min(n, self.capacity) - self.tokens) / self.rate)
+
+    def consume(self, n) -> None:
+        self._refill()
+        self.tokens -= min(n, self.capacity)
+
+    def refund(self, n) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + n)
+
+
+class LLMScheduler:
+    """Admits assistant requests within requests-per-minute, tokens-per-minute and concurrency budgets.
+
+    Waiting requests are admitted strictly by priority and then by arrival, so background requests never delay
+    interactive ones. A budget set to None is not limited.
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None, max_concurrency: Optional[int] = 16):
+        self.max_concurrency = max_concurrency
+        self._rpm = TokenBucket(rpm) if rpm is not None else None
+        self._tpm = TokenBucket(tpm) if tpm is not None else None
+        self._waiting = []  # heap of (priority, seq, tokens)
+        self._seq = itertools.count()
+        self._n_running = 0
+        self._paused_until = 0.0
+        self._condition = None
+        self._waits = {priority: deque(maxlen=1000) for priority in PRIORITY_NAMES.keys()}
+        self._n_admitted = {priority: 0 for priority in PRIORITY_NAMES.keys()}
+
+    def _get_condition(self):
+        # created lazily, so that it belongs to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _time_until_ready(self, tokens) -> Optional[float]:
+        # returns None if only a finished request can free the budget
+        if self.max_concurrency is not None and self._n_running >= self.max_concurrency:
+            return None
+        delay = max(0.0, self._paused_until - time.monotonic())
+        if self._rpm is not None:
+            delay = max(delay, self._rpm.time_until(1))
+        if self._tpm is not None:
+            delay = max(delay, self._tpm.time_until(tokens))
+        return delay
+
+    async def acquire(self, tokens: int, priority: Optional[int] = None) -> None:
+        priority = llm_priority.get() if priority is None else priority
+        entry = (priority, next(self._seq), tokens)
+        enqueued = time.monotonic()
+        condition = self._get_condition()
+        async with condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    delay = self._time_until_ready(tokens) if self._waiting[0] is entry else None
+                    if delay == 0.0:
+                        break
+                    try:
+                        await asyncio.wait_for(condition.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._n_running += 1
+            if self._rpm is not None:
+                self._rpm.consume(1)
+            if self._tpm is not None:
+                self._tpm.consume(tokens)
+            self._waits[priority].append(time.monotonic() - enqueued)
+            self._n_admitted[priority] += 1
+            # the next waiter may be admitted right away
+            condition.notify_all()
+
+    async def release(self, estimated_tokens: int, used_tokens: Optional[int] = None) -> None:
+        condition = self._get_condition()
+        async with condition:
+            self._n_running -= 1
+            if self._tpm is not None and used_tokens is not None and used_tokens < estimated_tokens:
+                self._tpm.refund(estimated_tokens - used_tokens)
+            condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, tokens: int, priority: Optional[int] = None):
+        """Waits until a request of the estimated number of tokens can be sent.
+
+        The yielded dict can be given the actual usage under 'used_tokens', unused tokens are returned to the budget.
+        """
+        await self.acquire(tokens, priority)
+        usage = dict(used_tokens=None)
+        try:
+            yield usage
+        finally:
+            await self.release(tokens, usage['used_tokens'])
+
+    def pause(self, seconds: float) -> None:
+        # called when the API reports a rate limit, no request is admitted during the pause
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        res = dict(running=self._n_running, paused=max(0.0, self._paused_until - time.monotonic()))
+        for priority, name in PRIORITY_NAMES.items():
+            waits = np.array(self._waits[priority]) if len(self._waits[priority]) > 0 else np.zeros(1)
+            res[name] = dict(queued=sum(1 for entry in self._waiting if entry[0] == priority),
+                             admitted=self._n_admitted[priority],
+                             wait_mean=float(waits.mean()), wait_p95=float(np.percentile(waits, 95)),
+                             wait_max=float(waits.max()))
+        return res
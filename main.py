@@ -1,24 +1,34 @@
 import asyncio
+from collections import deque
+import hmac
 import json
 import os.path
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 import signal
-from zoneinfo import ZoneInfo
+import threading
+import time
 
-import jinja2
-from flask import Flask
-import requests
+from flask import Flask, abort, request
+import numpy as np
 
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, MessageHandler, filters, CommandHandler, CallbackQueryHandler, ContextTypes
 import telegramify_markdown
 
+from audio_cache import AudioCache
+from chat_locks import ChatLocks
 from decks_db import DecksDB
 from exercise import Exercise
 from learning_plan import LearningPlan
+from llm_scheduler import BACKGROUND, llm_priority
+from ping_scheduler import PingScheduler
+from prefetch import ExercisePrefetcher
+from storage import CsvStorage, SqliteStorage, csv_paths
 from templates import Templates
-from utils import get_audio
+from utils import close_openai_client, close_response_cache, get_audio, get_llm_scheduler, get_model_router, init_llm_scheduler, \
+    init_model_router, init_openai_client, init_response_cache
 from words_progress_db import WordsProgressDB
 from user_config import UserConfig
 from words_db import WordsDB
@@ -28,6 +38,7 @@ from running_activities import RunningActivities
 import logging
 
 
+logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s', level=logging.INFO)
 # Disable optional logging
 logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.getLogger('apscheduler').setLevel(logging.WARNING)
@@ -45,6 +56,9 @@ if BOT_TOKEN_RU is not None:
     BOT_TOKENS.append(BOT_TOKEN_RU)
     BOT_LANGS.append('russian')
 
+AUDIO_VOICE = 'alloy'
+AUDIO_FORMAT = 'wav'
+
 
 async def handle_new_exercise(bot, chat_id, exercise):
     try:
@@ -52,6 +66,13 @@ async def handle_new_exercise(bot, chat_id, exercise):
         lang = user_data['language']
         uilang = lang_map[bot.token]
 
+        first_message = None
+        progressive = None
+        if prefetcher is not None:
+            prefetched = prefetcher.take(chat_id, exercise)
+            if prefetched is not None:
+                exercise, first_message = prefetched
+
         running_activities.add_activity(chat_id, exercise)
         if isinstance(exercise, WordsExerciseLearn):
             lp.process_response(chat_id, exercise, quality=None)
@@ -61,15 +82,20 @@ async def handle_new_exercise(bot, chat_id, exercise):
             if not isinstance(exercise, WordsExerciseLearn) and "show_words_due" in user_data.keys() and user_data['show_words_due']:
                 words_due = lp.get_due_today(chat_id, lang)
 
-                message_template = templates.get_template(uilang, lang, 'words_due')
-                template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+                template = templates.get_template(uilang, lang, 'words_due')
                 due_message = template.render(n_words=len(words_due)).strip()
                 if len(words_due) > 0:
                     due_message = f'{due_message}\n\n---------------\n\n'
             else:
                 due_message = ''
 
-            message, _ = await exercise.get_next_user_message(user_response=None)
+            if first_message is None and stream_responses and isinstance(exercise, WordsExerciseLearn):
+                progressive = ProgressiveMessage(bot, chat_id, min_interval=stream_edit_interval)
+                message, _ = await exercise.get_next_user_message(user_response=None, on_partial=progressive.update)
+            elif first_message is None:
+                message, _ = await exercise.get_next_user_message(user_response=None)
+            else:
+                message = first_message
 
             message = f'{due_message}{message}'
 
@@ -86,46 +112,62 @@ async def handle_new_exercise(bot, chat_id, exercise):
             message = f'{interface["Error"][uilang]}: {e}'
             buttons = None
 
-        await tel_send_message(bot, chat_id, message, buttons=buttons)
+        if progressive is not None:
+            await progressive.finish(message, buttons=buttons)
+        else:
+            await tel_send_message(bot, chat_id, message, buttons=buttons)
     except Exception as e:
         if chat_id in running_activities.chat_ids: running_activities.pop_all(chat_id)
-        release_all_locks()
         print(e)
         await tel_send_message(bot, chat_id, interface['Something went terribly wrong, please try again or notify the admin'][uilang])
 
 
 async def ping_user(bot, chat_id, lang, exercise_type, exercise_data):
     uilang = lang_map[bot.token]
-    if exercise_type == 'words':
-        exercise = await lp.get_next_words_exercise(chat_id, lang, mode=exercise_data)
-    else:
-        raise ValueError(f'Unknown exercise type {exercise_type}')
+    async with chat_locks(chat_id):
+        if exercise_type == 'words':
+            exercise = await lp.get_next_words_exercise(chat_id, lang, mode=exercise_data)
+        else:
+            raise ValueError(f'Unknown exercise type {exercise_type}')
 
-    if exercise is None:
-        await tel_send_message(bot, chat_id, interface['Could not create an exercise, will try again later'][uilang])
-        print(f'Could not create an exercise {exercise_type} for data {exercise_data}.')
-    else:
-        await handle_new_exercise(bot, chat_id, exercise)
+        if exercise is None:
+            await tel_send_message(bot, chat_id, interface['Could not create an exercise, will try again later'][uilang])
+            print(f'Could not create an exercise {exercise_type} for data {exercise_data}.')
+        else:
+            await handle_new_exercise(bot, chat_id, exercise)
 
 
-async def tel_send_audio(bot, chat_id, audio_file_path):
-    with open(audio_file_path, 'rb') as audio_file:
-        payload = {
-            'chat_id': str(chat_id),
-            'title': 'audio.mp3',
-            'parse_mode': 'HTML'
-        }
-        files = {
-            'audio': audio_file.read(),
-        }
+def per_chat(handler):
+    # the handler is called with the lock of the chat of the update held
+    async def handle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        chat_id = chat.id if chat is not None else update.effective_user.id
+        async with chat_locks(chat_id):
+            return await handler(update, context)
+    return handle
 
-        resp = requests.post(
-            f"https://api.telegram.org/bot{bot.token}/sendAudio",
-            data=payload,
-            files=files)
-        resp.json()
 
-async def tel_send_message(bot, chat_id, text, buttons=None):
+async def tel_send_audio(bot, chat_id, text, lang):
+    # sends the pronunciation of text, generated once and uploaded to telegram once per bot
+    key = AudioCache.make_key(text, lang, AUDIO_VOICE, AUDIO_FORMAT)
+    file_id = audio_cache.get_file_id(bot.token, key)
+    if file_id is not None:
+        try:
+            await bot.send_audio(chat_id, audio=file_id)
+            return
+        except BadRequest as e:
+            print(f'Could not send audio by file id, uploading it again: {e}')
+            audio_cache.set_file_id(bot.token, key, None)
+
+    audio = await audio_cache.get_or_generate(text, lang, AUDIO_VOICE, AUDIO_FORMAT,
+                                              lambda: get_audio(text, lang, voice=AUDIO_VOICE, audio_format=AUDIO_FORMAT))
+    message = await bot.send_audio(chat_id, audio=audio, filename=f'audio.{AUDIO_FORMAT}')
+    sent = message.audio or message.voice or message.document
+    if sent is not None:
+        audio_cache.set_file_id(bot.token, key, sent.file_id)
+
+
+def tel_reply_markup(bot, text, buttons=None):
 
     # determine max line length to know if to display buttons on separate lines or on the same one
     lines = text.split('\n')
@@ -146,9 +188,92 @@ async def tel_send_message(bot, chat_id, text, buttons=None):
         reply_markup = {
             "inline_keyboard": buttons_to_send
         }
+    return reply_markup
+
 
+async def tel_send_message(bot, chat_id, text, buttons=None):
     converted = telegramify_markdown.markdownify(text)
-    await bot.send_message(chat_id, converted, reply_markup=reply_markup,  parse_mode="MarkdownV2")
+    return await bot.send_message(chat_id, converted, reply_markup=tel_reply_markup(bot, text, buttons),  parse_mode="MarkdownV2")
+
+
+class ProgressiveMessage:
+    """A message that shows a response while it is being generated.
+
+    It is sent on the first update, or replaces the text of message_id, and is then edited with every update. Telegram
+    limits how often a message can be edited, updates coming within min_interval seconds of the last edit are merged.
+    """
+
+    def __init__(self, bot, chat_id, message_id=None, min_interval=1.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self._shown = None
+        self._pending = None
+        self._next_edit = 0.0
+        self._task = None
+
+    def update(self, text) -> None:
+        # does not wait for telegram, so it can be called for every chunk of the response
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending is not None:
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text, self._pending = self._pending, None
+            if text is None or text == self._shown:
+                continue
+            try:
+                await self._show(text)
+            except RetryAfter as e:
+                self._next_edit = time.monotonic() + self._seconds(e.retry_after)
+                if self._pending is None:
+                    self._pending = text
+                continue
+            except TelegramError as e:
+                print(f'Could not update a message: {e}')
+            self._next_edit = time.monotonic() + self.min_interval
+
+    @staticmethod
+    def _seconds(retry_after):
+        return retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+
+    async def _show(self, text, buttons=None):
+        converted = telegramify_markdown.markdownify(text)
+        reply_markup = tel_reply_markup(self.bot, text, buttons)
+        if self.message_id is None:
+            message = await self.bot.send_message(self.chat_id, converted, reply_markup=reply_markup, parse_mode="MarkdownV2")
+            self.message_id = message.message_id
+        else:
+            await self.bot.edit_message_text(converted, chat_id=self.chat_id, message_id=self.message_id,
+                                             reply_markup=reply_markup, parse_mode="MarkdownV2")
+        self._shown = text
+
+    async def finish(self, text, buttons=None) -> None:
+        """Shows the complete message with its buttons."""
+        self._pending = None
+        if self._task is not None:
+            # waits for an edit that is being sent, so that the message is not sent twice
+            await self._task
+        delay = self._next_edit - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        for _ in range(3):
+            try:
+                await self._show(text, buttons)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(self._seconds(e.retry_after))
+            except BadRequest as e:
+                if 'not modified' in str(e):
+                    return
+                print(f'Could not update a message: {e}')
+                break
+        await tel_send_message(self.bot, self.chat_id, text, buttons=buttons)
 
 
 async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -167,7 +292,6 @@ async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await handle_next_test(update, context)
     except Exception as e:
         if chat_id in running_activities.chat_ids: running_activities.pop_all(chat_id)
-        release_all_locks()
         print(e)
         await tel_send_message(bot, chat_id, interface['Something went terribly wrong, please try again or notify the admin'][uilang])
 
@@ -222,8 +346,7 @@ async def handle_exercise_button_press(update, context, chat_id, lang, udata, ex
                 words_progress_db.ignore_word(chat_id, exercise.word_id)
                 words_progress_db.save_progress()
 
-                message_template = templates.get_template(uilang, lang, 'word_ignore_message')
-                template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+                template = templates.get_template(uilang, lang, 'word_ignore_message')
                 mes = template.render(word=exercise.word)
                 await tel_send_message(bot, chat_id, mes)
 
@@ -237,8 +360,7 @@ async def handle_exercise_button_press(update, context, chat_id, lang, udata, ex
                     lp.process_hint(chat_id, running_exercise)
                     words_progress_db.save_progress()
 
-                message_template = templates.get_template(uilang, lang, 'hint_message')
-                template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+                template = templates.get_template(uilang, lang, 'hint_message')
                 mes = template.render(word=exercise.word)
                 await tel_send_message(bot, chat_id, mes)
 
@@ -256,8 +378,7 @@ async def handle_exercise_button_press(update, context, chat_id, lang, udata, ex
             #     lp.set_word_easy(chat_id, exercise.word_id)
             #     words_progress_db.save_progress()
 
-            #     message_template = templates.get_template(uilang, lang, 'know_word_message')
-            #     template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+            #     template = templates.get_template(uilang, lang, 'know_word_message')
             #     mes = template.render(word=exercise.word)
             #     await tel_send_message(bot, chat_id, mes)
 
@@ -266,21 +387,14 @@ async def handle_exercise_button_press(update, context, chat_id, lang, udata, ex
 
             #     if n_seen_words % 10 == 0:
 
-            #         message_template = templates.get_template(uilang, lang, 'congrats_learn_message')
-            #         template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+            #         template = templates.get_template(uilang, lang, 'congrats_learn_message')
             #         mes = template.render(n_seen_words=n_seen_words)
             #         await tel_send_message(bot, chat_id, mes)
 
             elif f'Answer audio' == udata:
-                file_path = f'{chat_id}_{exercise.uid}.mp3'
-                get_audio(exercise.correct_answer(), exercise.lang, file_path)
-                await tel_send_audio(bot, chat_id, file_path)
-                os.remove(file_path)
+                await tel_send_audio(bot, chat_id, exercise.correct_answer(), exercise.lang)
             elif f'Pronounce' == udata:
-                file_path = f'{chat_id}_{exercise.uid}.mp3'
-                get_audio(exercise.word, exercise.lang, file_path)
-                await tel_send_audio(bot, chat_id, file_path)
-                os.remove(file_path)
+                await tel_send_audio(bot, chat_id, exercise.word, exercise.lang)
             elif f'Next' == udata:
                 await tel_send_message(bot, chat_id, f'{interface["Thinking"][uilang]}...')
                 mode = 'learn' if isinstance(exercise, WordsExerciseLearn) else 'test'
@@ -317,7 +431,6 @@ async def handle_exercise_button_press(update, context, chat_id, lang, udata, ex
             raise ValueError(f'Unknown exercise type: {type(exercise)}.')
     except Exception as e:
         if chat_id in running_activities.chat_ids: running_activities.pop_all(chat_id)
-        release_all_locks()
         print(e)
         await tel_send_message(bot, chat_id, interface['Something went terribly wrong, please try again or notify the admin'][uilang])
 
@@ -328,15 +441,13 @@ def execute_command_message(context, chat_id, lang, command, msg):
     if command == 'add_word':
         words = msg.strip().split('\n')
         custom_deck_id = decks_db.get_custom_deck_id(str(chat_id), lang)
-        for word in words:
-            word_id = words_db.add_new_word(word, lang)
-            decks_db.add_new_word(custom_deck_id, word_id)
+        word_ids = words_db.add_new_words(words, lang)
+        decks_db.add_new_words(custom_deck_id, word_ids)
         words_db.save_words_db()
         decks_db.save_decks_db()
 
-        message_template = templates.get_template(uilang, lang, 'add_word_message')
-        template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
-        user_msg = template.render(word=word)
+        template = templates.get_template(uilang, lang, 'add_word_message')
+        user_msg = template.render(word=words[-1])
 
     else:
         raise ValueError(f'Unexpected command {command}.')
@@ -370,7 +481,6 @@ async def handle_inline_request(update, context):
 
     except Exception as e:
         if chat_id in running_activities.chat_ids: running_activities.pop_all(chat_id)
-        release_all_locks()
         print(e)
         await tel_send_message(bot, chat_id, interface['Something went terribly wrong, please try again or notify the admin'][uilang])
 
@@ -394,8 +504,11 @@ async def handle_request(update, context):
                 
                 exercise.is_responded = True
 
-                await tel_send_message(bot, chat_id, f'{interface["Thinking"][uilang]}...')
-                message, quality = await exercise.get_next_user_message(user_response=msg)
+                thinking_message = await tel_send_message(bot, chat_id, f'{interface["Thinking"][uilang]}...')
+                # the correction replaces the thinking message, streamed if enabled
+                progressive = ProgressiveMessage(bot, chat_id, thinking_message.message_id, min_interval=stream_edit_interval)
+                message, quality = await exercise.get_next_user_message(user_response=msg,
+                                                                        on_partial=progressive.update if stream_responses else None)
                 
                 buttons = None
                 if isinstance(exercise, WordsExerciseLearn):
@@ -407,7 +520,7 @@ async def handle_request(update, context):
                     # buttons = ['Discard', 'I know this word', 'Next']
                     buttons = ['Discard', 'Next']
 
-                await tel_send_message(bot, chat_id, message, buttons=buttons)
+                await progressive.finish(message, buttons=buttons)
                 words_progress_db.save_progress()
             else:
                 await tel_send_message(bot, chat_id, f'{interface["The exercise has already been answered, this message will be ignored"][uilang]}: {msg}')
@@ -425,68 +538,149 @@ async def handle_request(update, context):
 
     except Exception as e:
         if chat_id in running_activities.chat_ids: running_activities.pop_all(chat_id)
-        release_all_locks()
         print(e)
         await tel_send_message(bot, chat_id, interface['Something went terribly wrong, please try again or notify the admin'][uilang])
     return
 
 
-def release_all_locks():
-    for shared_obj in shared_objs:
-        shared_obj.release_lock()
-
-
-async def ping_users(context):
-    user_data = user_config.get_all_user_data()
-    bot = context._application.bot
-    uilang = lang_map[bot.token]
-    is_weekend = (datetime.now().weekday() == 5 or datetime.now().weekday() == 6)
-    schedule_col = 'weekend' if is_weekend else 'weekday'
-
+async def ping_users(bots, due):
+    # due is a list of (chat_id, mode, scheduled time) of the pings to send, bots maps ui languages to bots
     users_to_ping = []
-    for chat_id, v in user_data.items():
-        if v['ui_language'] != uilang: continue
-
-        user_now = datetime.now(tz=ZoneInfo(user_data[chat_id]["timezone"]))
-
-        if 'words' in user_data[chat_id]['exercise_types']:
-            ping_schedule = user_data[chat_id]['schedule']['words'][schedule_col]
-
-            user_ping_times = [datetime.combine(user_now.date(), ptime) for ptime in ping_schedule.keys()]
-
-            ping_schedule = [pexersize for uptime, pexersize in zip(user_ping_times, ping_schedule.values()) 
-                                if abs(uptime - user_now) <= timedelta(minutes=1)]
-            if len(ping_schedule) == 0:
-                continue
-            users_to_ping.append(dict(chat_id=chat_id, lang=user_data[chat_id]['language'], exercise=ping_schedule[0]))
-
-    try:
-        for user in users_to_ping:
-            await ping_user(bot, user['chat_id'], user['lang'], 'words', user['exercise'])
-    except Exception as e:
-        if chat_id in running_activities.chat_ids: running_activities.pop_all(chat_id)
-        release_all_locks()
-        print(e)
-
-
-def nearest_start_time(ping_interval=15 * 60):
-
-    n_pings_per_hour = 60 * 60 // ping_interval
-    ping_times = [ping_interval * (i + 1) // 60 for i in range(n_pings_per_hour)]
-    if 60 not in ping_times:
-        ping_times.append(60)
-
-    now = datetime.now()
-    starting_point_min = [ping_time for ping_time in ping_times if ping_time - now.minute >= 1][0]
-
-    next_starting_point = now + timedelta(minutes=starting_point_min-now.minute)
-
-    next_sec = (next_starting_point-datetime.now()).seconds
-    if next_sec < 0: next_sec = 10
-    return next_sec
+    for chat_id, mode, _ in due:
+        try:
+            user_data = user_config.get_user_data(chat_id)
+        except KeyError:
+            continue
+        bot = bots.get(user_data['ui_language'])
+        if bot is None:
+            continue
+        users_to_ping.append(dict(chat_id=chat_id, bot=bot, lang=user_data['language'], exercise=mode))
+
+    if len(users_to_ping) == 0:
+        return
+
+    # users are pinged concurrently, at most ping_concurrency at a time, a failed ping does not affect the others
+    semaphore = asyncio.Semaphore(ping_concurrency)
+    start = time.monotonic()
+
+    async def ping(user):
+        chat_id = user['chat_id']
+        async with semaphore:
+            try:
+                await ping_user(user['bot'], chat_id, user['lang'], 'words', user['exercise'])
+            except Exception as e:
+                if chat_id in running_activities.chat_ids: running_activities.pop_all(chat_id)
+                print(f'Could not ping {chat_id}: {e}')
+                return None
+        # seconds from the start of the batch until the user got the exercise
+        return time.monotonic() - start
+
+    delays = await asyncio.gather(*[ping(user) for user in users_to_ping])
+    delays = [delay for delay in delays if delay is not None]
+    batch = dict(users=len(users_to_ping), failed=len(users_to_ping) - len(delays), seconds=round(time.monotonic() - start, 2),
+                 p95=round(float(np.percentile(delays, 95)), 2) if len(delays) > 0 else None)
+    ping_batches.append(batch)
+    print(f'Pinged {batch["users"]} users: {batch}')
+
+
+async def compact_progress(context):
+    # the snapshot is written in a worker thread, updates are handled in the meantime
+    await asyncio.to_thread(words_progress_db.compact)
+
+
+async def reset_long_due_words(context):
+    # runs every hour, the words of the users whose local time is between 00:00 and 01:00 are reset
+    now = datetime.now(timezone.utc)
+    local_dates = dict()
+    for chat_id in user_config.get_all_chat_ids():
+        local_now = now.astimezone(user_config.get_user_timezone(chat_id))
+        if local_now.hour == 0:
+            local_dates[chat_id] = local_now.date()
+    if len(local_dates) == 0:
+        return
+    # the databases are searched in a worker thread, the progress is reset on the event loop
+    long_due_df = await asyncio.to_thread(lp.find_long_due_words, local_dates)
+    lp.reset_words(long_due_df)
+
+
+async def run_ping_scheduler(bots):
+    # users do not wait for pings, their requests give way to replies
+    llm_priority.set(BACKGROUND)
+    batches = set()
+    while True:
+        next_time = ping_scheduler.next_time()
+        now = datetime.now(timezone.utc)
+        delay = 60.0 if next_time is None else (next_time - now).total_seconds()
+        if delay > 0:
+            # wakes up at least every minute, so that a change of the system clock is noticed
+            await asyncio.sleep(min(delay, 60.0))
+            continue
+        # a slow batch does not delay the next one
+        batch = asyncio.create_task(ping_users(bots, ping_scheduler.pop_due(now)))
+        batches.add(batch)
+        batch.add_done_callback(batches.discard)
+
+
+async def log_llm_stats(context):
+    print(f'LLM requests: {get_llm_scheduler().stats()}')
+    print(f'LLM models: {get_model_router().stats()}')
+    if len(ping_batches) > 0:
+        seconds = np.array([batch['seconds'] for batch in ping_batches])
+        print(f'Ping batches: {len(ping_batches)}, seconds mean {seconds.mean():.1f} max {seconds.max():.1f}, '
+              f'failed pings {sum(batch["failed"] for batch in ping_batches)}')
+
+
+async def prefetch_exercises(context):
+    n_started = prefetcher.prefetch_scheduled()
+    if n_started > 0:
+        print(f'Prefetching exercises for {n_started} users, {prefetcher.n_hits} hits and {prefetcher.n_misses} misses so far')
+
+
+def webhook_path(token):
+    # the bot id part of the token, the secret part must not appear in urls and proxy logs
+    return f'/webhook/{token.split(":")[0]}'
+
+
+@app.post('/webhook/<bot_id>')
+def handle_webhook(bot_id):
+    # called in a waitress worker thread, the update is handled by the application in the event loop
+    application = webhook_apps.get(f'/webhook/{bot_id}')
+    if application is None:
+        abort(404)
+    # compared as bytes, compare_digest raises on str with non-ASCII characters
+    if not hmac.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode('utf-8'), webhook_secret.encode('utf-8')):
+        abort(403)
+    data = request.get_json(silent=True)
+    if data is None:
+        abort(400)
+    update = Update.de_json(data, application.bot)
+    asyncio.run_coroutine_threadsafe(application.update_queue.put(update), event_loop).result(timeout=10)
+    return '', 200
+
+
+@app.get('/healthz')
+def handle_healthz():
+    return 'ok', 200
+
+
+def start_webhook_server():
+    # imported here, waitress is only needed in webhook mode
+    import waitress
+
+    # behind a reverse proxy, the proxy's forwarded headers are trusted
+    trusted_proxy = os.getenv('WEBHOOK_TRUSTED_PROXY')
+    proxy_kwargs = dict(trusted_proxy=trusted_proxy, trusted_proxy_headers='x-forwarded-for x-forwarded-proto x-forwarded-host',
+                        clear_untrusted_proxy_headers=True) if trusted_proxy else dict()
+    server = waitress.create_server(app, host=os.getenv('WEBHOOK_HOST', '0.0.0.0'), port=int(os.getenv('WEBHOOK_PORT', 8080)),
+                                    threads=int(os.getenv('WEBHOOK_THREADS', 8)), **proxy_kwargs)
+    threading.Thread(target=server.run, name='webhook-server', daemon=True).start()
+    print(f'Serving webhooks on {os.getenv("WEBHOOK_HOST", "0.0.0.0")}:{os.getenv("WEBHOOK_PORT", 8080)}')
+    return server
 
 
 async def run_apps(apps):
+    global event_loop
+    event_loop = asyncio.get_running_loop()
 
     stop_event = asyncio.Event()
     
@@ -498,23 +692,50 @@ async def run_apps(apps):
     
         stop_event.set()
     
+    def reload_handler(signum, frame):
+        # templates can be edited without a restart, kill -HUP reloads them
+        try:
+            templates.reload()
+            print('Templates reloaded')
+        except Exception as e:
+            print(f'Could not reload templates, the old ones are kept: {e}')
+
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
+
+    init_openai_client()
 
     for app in apps:
         await app.initialize()
         await app.start()
     
+    webhook_server = None
     try:
-        polling_tasks = [
-            asyncio.create_task(
-                app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
-            ) for app in apps
-        ]
+        if webhook_url is not None:
+            # telegram posts updates to the endpoint of each bot, setting the webhook stops polling
+            webhook_server = start_webhook_server()
+            for app in apps:
+                await app.bot.set_webhook(url=f'{webhook_url}{webhook_path(app.bot.token)}', secret_token=webhook_secret,
+                                          allowed_updates=Update.ALL_TYPES,
+                                          max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)))
+            polling_tasks = []
+        else:
+            polling_tasks = [
+                asyncio.create_task(
+                    app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                ) for app in apps
+            ]
+        # users are pinged by the bot of their ui language
+        ping_task = asyncio.create_task(run_ping_scheduler({lang_map[app.bot.token]: app.bot for app in apps}))
+        polling_tasks.append(ping_task)
         await stop_event.wait()
 
     finally:
 
+        if webhook_server is not None:
+            webhook_server.close()
+
         for app in apps:
             if app.updater.running:
                 await app.updater.stop()
@@ -531,6 +752,11 @@ async def run_apps(apps):
             await app.stop()
             await app.shutdown()
 
+        await close_openai_client()
+        close_response_cache()
+        words_progress_db.compact()
+        storage.close()
+
 
 if __name__ == '__main__':
 
@@ -540,51 +766,110 @@ if __name__ == '__main__':
     user_data_root = os.getenv('CH_USER_DATA_ROOT')
     user_data_root = 'resources' if user_data_root is None else user_data_root
     user_data_root = Path(user_data_root)
-    words_db_path = user_data_root / 'words_db.csv'
-    decks_db_path = user_data_root / 'decks_db.csv'
-    deck_word_db_path = user_data_root / 'deck_word.csv'
-    words_progress_db_path = user_data_root / 'words_progress_db.csv'
     user_config_path = user_data_root / 'user_config.json'
 
     TIMEZONE = os.getenv('TIMEZONE')
+    compact_interval = int(os.getenv('PROGRESS_COMPACT_INTERVAL', 60 * 60))
+
+    # 'csv' keeps the tables in the CSV files of user_data_root, 'sqlite' in a single database (see storage.py for migration)
+    storage_backend = os.getenv('STORAGE_BACKEND', 'csv')
+    if storage_backend == 'csv':
+        storage = CsvStorage(csv_paths(user_data_root))
+    elif storage_backend == 'sqlite':
+        storage = SqliteStorage(user_data_root / 'flashbot.sqlite')
+    else:
+        raise ValueError(f'Unknown storage backend {storage_backend}.')
 
-    words_db = WordsDB(words_db_path)
-    decks_db = DecksDB(decks_db_path, deck_word_db_path)
-    words_progress_db = WordsProgressDB(words_progress_db_path)
+    words_db = WordsDB(storage)
+    decks_db = DecksDB(storage)
+    words_progress_db = WordsProgressDB(storage)
     user_config = UserConfig(user_config_path)
 
+    # generated examples are shared between users, LLM_CACHE=0 disables the cache
+    if os.getenv('LLM_CACHE', '1') != '0':
+        init_response_cache(os.getenv('LLM_CACHE_PATH', str(user_data_root / 'llm_cache.sqlite')),
+                            ttl=int(os.getenv('LLM_CACHE_TTL', 7 * 24 * 60 * 60)),
+                            n_variants=int(os.getenv('LLM_CACHE_VARIANTS', 3)),
+                            max_disk_keys=int(os.getenv('LLM_CACHE_MAX_KEYS', 100000)))
+
     with open('resources/interface.json', 'r', encoding='utf-8') as fp:
         interface = json.loads(fp.read())
 
     templates = Templates(str(Path('resources/templates')))
 
     lp = LearningPlan(interface, templates, words_progress_db=words_progress_db, words_db=words_db, decks_db=decks_db, user_config=user_config)
+    lp.reset_long_due_words()
+
+    # limits of requests to the assistant, unset limits are not enforced
+    init_llm_scheduler(rpm=int(os.getenv('LLM_RPM')) if os.getenv('LLM_RPM') else None,
+                       tpm=int(os.getenv('LLM_TPM')) if os.getenv('LLM_TPM') else None,
+                       max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', 16)))
 
-    shared_objs = [user_config, words_db, words_progress_db, decks_db, running_activities]
+    # the substitute model is asked too if the base model is slower than LLM_HEDGE_DELAY seconds,
+    # or than its recent 95th percentile of latency if unset
+    init_model_router(hedge_delay=float(os.getenv('LLM_HEDGE_DELAY')) if os.getenv('LLM_HEDGE_DELAY') else None,
+                      cooldown=float(os.getenv('LLM_CIRCUIT_COOLDOWN', 60)))
+
+    # first messages of upcoming tests are generated in the background, PREFETCH=0 disables it
+    # next scheduled ping of every user
+    ping_scheduler = PingScheduler(user_config)
+
+    prefetcher = ExercisePrefetcher(lp, user_config, ping_scheduler, ttl=int(os.getenv('PREFETCH_TTL', 10 * 60))) \
+        if os.getenv('PREFETCH', '1') != '0' else None
+    prefetch_interval = 5 * 60
+
+    # generated pronunciations, AUDIO_CACHE_MAX_MB limits the size of the files
+    audio_cache = AudioCache(os.getenv('AUDIO_CACHE_PATH', str(user_data_root / 'audio_cache')),
+                             max_bytes=int(os.getenv('AUDIO_CACHE_MAX_MB', 200)) * 1024 * 1024)
+
+    # learn exercises and corrections are shown while they are generated, STREAM_RESPONSES=0 disables it
+    stream_responses = os.getenv('STREAM_RESPONSES', '1') != '0'
+    stream_edit_interval = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+
+    # scheduled pings of one slot are sent concurrently, PING_CONCURRENCY limits how many are prepared at once
+    ping_concurrency = int(os.getenv('PING_CONCURRENCY', 32))
+    ping_batches = deque(maxlen=100)  # users, failed pings and seconds of the recent ping batches
+
+    # updates of a chat are handled in order, updates of different chats concurrently
+    chat_locks = ChatLocks()
 
     # list of known exercise buttons
     # exercise_buttons = ['Discard', 'Hint', 'Correct answer', 'I know this word', 'Answer audio', 'Next', 'Pronounce', 'Easier', 'Harder']
     exercise_buttons = ['Discard', 'Hint', 'Correct answer', 'Answer audio', 'Next', 'Pronounce', 'Easier', 'Harder']
 
+    # updates are received by webhooks if WEBHOOK_URL is set, e.g. https://bot.example.com, otherwise by polling
+    webhook_url = os.getenv('WEBHOOK_URL')
+    webhook_url = webhook_url.rstrip('/') if webhook_url else None
+    webhook_secret = os.getenv('WEBHOOK_SECRET')
+    if webhook_url is not None and not webhook_secret:
+        raise ValueError('WEBHOOK_SECRET must be set in webhook mode.')
+    webhook_apps = dict()  # url path -> application
+    event_loop = None
+
     apps = []
     lang_map = {}
 
     for bidx, (token, lang) in enumerate(zip(BOT_TOKENS, BOT_LANGS)):
-        application = Application.builder().token(token).build()
+        application = Application.builder().token(token).concurrent_updates(True).build()
 
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_request))
-        application.add_handler(CommandHandler("add_word", handle_command))
-        application.add_handler(CommandHandler("next_test", handle_command))
-        application.add_handler(CommandHandler("next_new", handle_command))
-        application.add_handler(CallbackQueryHandler(handle_inline_request))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_chat(handle_request)))
+        application.add_handler(CommandHandler("add_word", per_chat(handle_command)))
+        application.add_handler(CommandHandler("next_test", per_chat(handle_command)))
+        application.add_handler(CommandHandler("next_new", per_chat(handle_command)))
+        application.add_handler(CallbackQueryHandler(per_chat(handle_inline_request)))
 
         job_queue = application.job_queue
-        ping_interval = 15 * 60
-        first_ping = nearest_start_time(ping_interval)
-        print(f"First ping scheduled in: {first_ping} sec")
-        
-        job_queue.run_repeating(ping_users, interval=ping_interval, first=first_ping, job_kwargs={'misfire_grace_time': None})
+        if bidx == 0:
+            # all bots share the same progress db, so it is compacted by the first one only
+            job_queue.run_repeating(compact_progress, interval=compact_interval, first=compact_interval)
+            # at one minute past every hour, users are reset once a day in the first hour of their local day
+            first_reset = (datetime.now(timezone.utc) + timedelta(hours=1)).replace(minute=1, second=0, microsecond=0)
+            job_queue.run_repeating(reset_long_due_words, interval=60 * 60, first=first_reset)
+            if prefetcher is not None:
+                job_queue.run_repeating(prefetch_exercises, interval=prefetch_interval, first=10)
+            job_queue.run_repeating(log_llm_stats, interval=15 * 60, first=15 * 60)
         apps.append(application)
         lang_map[token] = lang
+        webhook_apps[webhook_path(token)] = application
 
     asyncio.run(run_apps(apps))
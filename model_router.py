@@ -0,0 +1,138 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+
+class ModelHealth:
+    """Recent latencies and outcomes of requests to one model, with a circuit breaker.
+
+    The circuit opens when at least error_threshold of the last window requests failed and stays open for cooldown
+    seconds. After that one request is let through, the circuit closes again if it succeeds.
+    """
+
+    def __init__(self, window=20, error_threshold=0.5, cooldown=60.0):
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=200)  # seconds of successful requests
+        self.outcomes = deque(maxlen=window)  # True for a success
+        self.open_until = 0.0
+        self._probing = False
+
+    def record(self, latency: Optional[float], ok: bool) -> None:
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+        if self._probing:
+            self._probing = False
+            if ok:
+                self.outcomes.clear()
+            else:
+                self.open_until = time.monotonic() + self.cooldown
+        elif len(self.outcomes) == self.outcomes.maxlen and self.error_rate() >= self.error_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+    def record_cancelled(self) -> None:
+        # a cancelled probe tells nothing, the next request probes again
+        if self._probing:
+            self._probing = False
+            self.open_until = time.monotonic()
+
+    def error_rate(self) -> float:
+        return 0.0 if len(self.outcomes) == 0 else 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+    def is_available(self) -> bool:
+        if self.open_until == 0.0:
+            return True
+        if time.monotonic() < self.open_until or self._probing:
+            return False
+        # half open, one request checks if the model has recovered
+        self._probing = True
+        self.open_until = 0.0
+        return True
+
+    def latency_quantile(self, q) -> Optional[float]:
+        return None if len(self.latencies) < 20 else float(np.quantile(np.array(self.latencies), q))
+
+
+class ModelRouter:
+    """Sends a request to the primary model and hedges it with the substitute model.
+
+    If the primary has not answered within the hedge delay, the same request is sent to the substitute and the first
+    answer wins. The hedge delay is hedge_delay seconds if set, otherwise the hedge_quantile of the primary's recent
+    latencies (default_hedge_delay until enough latencies are known). Requests go straight to the substitute while
+    the primary's circuit is open, and to the substitute if the primary fails.
+    """
+
+    def __init__(self, hedge_delay: Optional[float] = None, hedge_quantile=0.95, default_hedge_delay=8.0, **health_kwargs):
+        self.hedge_delay = hedge_delay
+        self.hedge_quantile = hedge_quantile
+        self.default_hedge_delay = default_hedge_delay
+        self.health_kwargs = health_kwargs
+        self._health = dict()  # model -> ModelHealth
+        self.n_hedged = 0
+
+    def health(self, model) -> ModelHealth:
+        if model not in self._health:
+            self._health[model] = ModelHealth(**self.health_kwargs)
+        return self._health[model]
+
+    def get_hedge_delay(self, model) -> float:
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        delay = self.health(model).latency_quantile(self.hedge_quantile)
+        return self.default_hedge_delay if delay is None else delay
+
+    async def _timed(self, model, send):
+        start = time.monotonic()
+        try:
+            res = await send(model)
+        except asyncio.CancelledError:
+            # a cancelled request says nothing about the model
+            self.health(model).record_cancelled()
+            raise
+        except Exception:
+            self.health(model).record(None, False)
+            raise
+        self.health(model).record(time.monotonic() - start, True)
+        return res
+
+    async def run(self, primary: str, substitute: Optional[str], send: Callable[[str], Awaitable]):
+        """Returns the result of send(model) of the model that answered first."""
+        if substitute is None or substitute == primary:
+            return await self._timed(primary, send)
+        if not self.health(primary).is_available():
+            return await self._timed(substitute, send)
+
+        primary_task = asyncio.ensure_future(self._timed(primary, send))
+        substitute_task = None
+        try:
+            done, _ = await asyncio.wait([primary_task], timeout=self.get_hedge_delay(primary))
+            if primary_task in done and primary_task.exception() is None:
+                return primary_task.result()
+
+            if primary_task not in done:
+                self.n_hedged += 1
+            substitute_task = asyncio.ensure_future(self._timed(substitute, send))
+            pending = {primary_task, substitute_task} - done
+            error = primary_task.exception() if primary_task in done else None
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in [primary_task, substitute_task]:
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        res = dict(hedged=self.n_hedged)
+        for model, health in self._health.items():
+            res[model] = dict(error_rate=health.error_rate(), open=time.monotonic() < health.open_until,
+                              p50=health.latency_quantile(0.5), p95=health.latency_quantile(0.95))
+        return res
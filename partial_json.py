@@ -0,0 +1,77 @@
+import json
+from typing import Optional
+
+
+_CLOSERS = {'{': '}', '[': ']'}
+
+
+def parse_partial_json(text: str) -> Optional[dict]:
+    """Parses the beginning of a JSON object that is still being streamed.
+
+    Returns the object with the values that are already known: complete values, and the beginning of the string
+    value that is being streamed. A number or a literal is only returned once it is followed by a delimiter. Returns
+    None if nothing can be parsed yet.
+    """
+    stack = []  # open brackets
+    in_string = False
+    is_key = False  # the open string is a key of an object
+    escaped = False
+    string_start = 0
+    expect_key = False  # the next string in the current object is a key
+    # longest prefix that is valid JSON once the open brackets are closed, and the brackets open at its end
+    safe_end, safe_stack = 0, []
+
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                if not is_key:
+                    safe_end, safe_stack = i + 1, list(stack)
+            continue
+
+        if ch == '"':
+            in_string = True
+            is_key = expect_key
+            string_start = i
+        elif ch in '{[':
+            stack.append(ch)
+            expect_key = ch == '{'
+            safe_end, safe_stack = i + 1, list(stack)
+        elif ch in '}]':
+            if len(stack) == 0:
+                break
+            stack.pop()
+            expect_key = False
+            safe_end, safe_stack = i + 1, list(stack)
+        elif ch == ',':
+            # the value before the comma is complete
+            safe_end, safe_stack = i, list(stack)
+            expect_key = len(stack) > 0 and stack[-1] == '{'
+        elif ch == ':':
+            expect_key = False
+
+    candidates = []
+    if in_string and not is_key:
+        # the string value that is being streamed, without an unfinished escape sequence
+        value = text[string_start:]
+        for cut in range(len(value), max(0, len(value) - 6), -1):
+            try:
+                json.loads(value[:cut] + '"')
+            except ValueError:
+                continue
+            candidates.append(text[:string_start] + value[:cut] + '"' + ''.join(_CLOSERS[b] for b in reversed(stack)))
+            break
+    candidates.append(text[:safe_end] + ''.join(_CLOSERS[b] for b in reversed(safe_stack)))
+
+    for candidate in candidates:
+        try:
+            res = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(res, dict):
+            return res
+    return None
@@ -0,0 +1,90 @@
+import heapq
+import itertools
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+
+class PingScheduler:
+    """Next scheduled ping of every user, kept in a min-heap ordered by time.
+
+    Ping times are taken in the timezone of the user, from the weekday or the weekend schedule of the user's local
+    date, and can be at any minute. Taking the due pings costs time proportional to their number, each one is
+    replaced by the next ping of its user.
+    """
+
+    def __init__(self, user_config, exercise_type='words', now: Optional[datetime] = None):
+        self.user_config = user_config
+        self.exercise_type = exercise_type
+        self._heap = []  # (utc time, seq, chat_id, mode)
+        self._seq = itertools.count()
+        self.rebuild(now)
+
+    def rebuild(self, now: Optional[datetime] = None) -> None:
+        """Schedules the first ping after now of every user."""
+        now = datetime.now(timezone.utc) if now is None else now
+        self._heap = []
+        for chat_id, user_data in self.user_config.get_all_user_data().items():
+            self._push(chat_id, user_data, now)
+        heapq.heapify(self._heap)
+
+    def _push(self, chat_id, user_data, after):
+        if self.exercise_type not in user_data['exercise_types']:
+            return
+        next_ping = self.next_ping(user_data, after)
+        if next_ping is not None:
+            self._heap.append((next_ping[0], next(self._seq), chat_id, next_ping[1]))
+
+    def next_ping(self, user_data, after: datetime) -> Optional[tuple[datetime, str]]:
+        """Returns the UTC time and the mode of the first ping of the user strictly after after, None if there is none."""
+        tz = ZoneInfo(user_data['timezone'])
+        schedule = user_data['schedule'][self.exercise_type]
+        local_date = after.astimezone(tz).date()
+        # a week ahead covers both schedules, one more day covers the pings of the day that are already over
+        for day in range(8):
+            date = local_date + timedelta(days=day)
+            day_schedule = schedule['weekend' if date.weekday() in [5, 6] else 'weekday']
+            pings = []
+            for ping_time, mode in day_schedule.items():
+                ping_datetime = datetime.combine(date, ping_time.replace(tzinfo=None), tzinfo=tz).astimezone(timezone.utc)
+                if ping_datetime > after:
+                    pings.append((ping_datetime, mode))
+            if len(pings) > 0:
+                return min(pings, key=lambda ping: ping[0])
+        return None
+
+    def next_time(self) -> Optional[datetime]:
+        return self._heap[0][0] if len(self._heap) > 0 else None
+
+    def pop_due(self, now: Optional[datetime] = None) -> list[tuple[int, str, datetime]]:
+        """Returns (chat_id, mode, scheduled time) of the pings due by now and schedules the next ping of their users."""
+        now = datetime.now(timezone.utc) if now is None else now
+        due = []
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            ping_datetime, _, chat_id, mode = heapq.heappop(self._heap)
+            due.append((chat_id, mode, ping_datetime))
+
+        for chat_id, _, ping_datetime in due:
+            try:
+                user_data = self.user_config.get_user_data(chat_id)
+            except KeyError:
+                continue
+            # pings that were missed while the bot was busy are not repeated
+            next_ping = self.next_ping(user_data, max(ping_datetime, now))
+            if next_ping is not None:
+                heapq.heappush(self._heap, (next_ping[0], next(self._seq), chat_id, next_ping[1]))
+        return due
+
+    def upcoming(self, until: datetime) -> list[tuple[int, str, datetime]]:
+        """Returns (chat_id, mode, scheduled time) of the scheduled pings up to until, without removing them."""
+        res = []
+        # walks down the heap from the root, only entries up to until and their children are visited
+        to_visit = [0] if len(self._heap) > 0 else []
+        while len(to_visit) > 0:
+            idx = to_visit.pop()
+            ping_datetime, _, chat_id, mode = self._heap[idx]
+            if ping_datetime > until:
+                continue
+            res.append((chat_id, mode, ping_datetime))
+            to_visit.extend(child for child in [2 * idx + 1, 2 * idx + 2] if child < len(self._heap))
+        return sorted(res, key=lambda ping: ping[2])
@@ -0,0 +1,138 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from exercise import Exercise
+from llm_scheduler import BACKGROUND, llm_priority
+from words_exercise import generate_first_messages
+
+
+class ExercisePrefetcher:
+    """Generates first messages of the next test exercises of active users in the background.
+
+    A user is active if a scheduled ping is coming up or if they were served an exercise within the last ttl
+    seconds. Prefetched exercises expire after ttl seconds and are dropped as soon as the progress on their word
+    changes. handle_new_exercise takes a prefetched exercise instead of generating the same one.
+    """
+
+    def __init__(self, lp, user_config, ping_scheduler, ttl=10 * 60, n_ahead=2, lead_time=15 * 60):
+        self.lp = lp
+        self.user_config = user_config
+        self.ping_scheduler = ping_scheduler
+        self.ttl = ttl
+        self.n_ahead = n_ahead
+        self.lead_time = lead_time
+        self._entries = dict()  # chat_id -> exercise key -> (created, exercise, first message)
+        self._generations = dict()  # chat_id -> number of invalidations, prefetches started before one are dropped
+        self._tasks = dict()  # chat_id -> running prefetch task
+        self._active = dict()  # chat_id -> (lang, time when an exercise was last served)
+        self.n_hits = 0
+        self.n_misses = 0
+        lp.progress_db.add_listener(self._on_progress_change)
+
+    @staticmethod
+    def _key(exercise: Exercise):
+        return type(exercise).__name__, exercise.word_id, exercise.lang, exercise.uilang, getattr(exercise, 'level', None)
+
+    def take(self, chat_id, exercise: Exercise) -> Optional[tuple[Exercise, str]]:
+        """Returns a prefetched exercise equal to exercise and its first message, or None if there is none."""
+        self._active[chat_id] = (exercise.lang, time.monotonic())
+        entry = self._entries.get(chat_id, dict()).pop(self._key(exercise), None)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return entry[1], entry[2]
+
+    def schedule(self, chat_id, lang, mode='test') -> None:
+        # starts a prefetch unless one is already running for the chat, must be called from the event loop
+        self.schedule_many([(chat_id, lang, mode)])
+
+    def schedule_many(self, requests) -> int:
+        """Starts one prefetch for all (chat_id, lang, mode) whose chat has no prefetch running.
+
+        Exercises of all chats are generated together, so that requests for the same words are batched.
+        Returns the number of chats whose prefetch was started.
+        """
+        requests = [request for request in requests if self._tasks.get(request[0]) is None or self._tasks[request[0]].done()]
+        if len(requests) == 0:
+            return 0
+        try:
+            task = asyncio.get_running_loop().create_task(self.prefetch(requests))
+        except RuntimeError:
+            return 0
+        for chat_id, _, _ in requests:
+            self._tasks[chat_id] = task
+        return len(requests)
+
+    async def prefetch(self, requests) -> None:
+        # predictions are redone for chats whose progress changes while messages are generated
+        llm_priority.set(BACKGROUND)
+        for _ in range(3):
+            interrupted = await self._prefetch(requests)
+            requests = [request for request in requests if request[0] in interrupted]
+            if len(requests) == 0:
+                return
+
+    async def _prefetch(self, requests) -> set:
+        # returns chat ids whose prefetch was interrupted by a change of progress
+        generations = {chat_id: self._generations.get(chat_id, 0) for chat_id, _, _ in requests}
+        chat_ids = []
+        exercises = []
+        for chat_id, lang, mode in requests:
+            try:
+                upcoming = self.lp.get_upcoming_tests(chat_id, lang, mode, self.n_ahead)
+            except Exception as e:
+                print(f'Could not predict exercises for {chat_id}: {e}')
+                continue
+            for exercise in upcoming:
+                entry = self._entries.get(chat_id, dict()).get(self._key(exercise))
+                if entry is None or time.monotonic() - entry[0] > self.ttl:
+                    chat_ids.append(chat_id)
+                    exercises.append(exercise)
+
+        messages = await generate_first_messages(exercises)
+
+        interrupted = set()
+        for chat_id, exercise, message in zip(chat_ids, exercises, messages):
+            if self._generations.get(chat_id, 0) != generations[chat_id]:
+                interrupted.add(chat_id)
+            elif message is not None:
+                self._entries.setdefault(chat_id, dict())[self._key(exercise)] = (time.monotonic(), exercise, message)
+        return interrupted
+
+    def _on_progress_change(self, chat_id, word_id, progress) -> None:
+        entries = self._entries.get(chat_id)
+        if entries is not None:
+            for key in [key for key in entries.keys() if key[1] == word_id]:
+                del entries[key]
+        self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+        if chat_id not in self._active:
+            return
+
+        # the user is doing exercises, prepare the ones after the changed word
+        lang, last_served = self._active[chat_id]
+        if time.monotonic() - last_served <= self.ttl:
+            self.schedule(chat_id, lang)
+
+    def prefetch_scheduled(self) -> int:
+        """Starts prefetches for users with a test ping within lead_time, drops expired exercises.
+
+        Returns the number of started prefetches.
+        """
+        now = time.monotonic()
+        for chat_id in list(self._entries.keys()):
+            self._entries[chat_id] = {key: entry for key, entry in self._entries[chat_id].items() if now - entry[0] <= self.ttl}
+        self._active = {chat_id: active for chat_id, active in self._active.items() if now - active[1] <= self.ttl}
+        self._tasks = {chat_id: task for chat_id, task in self._tasks.items() if not task.done()}
+
+        requests = []
+        for chat_id, mode, _ in self.ping_scheduler.upcoming(datetime.now(timezone.utc) + timedelta(seconds=self.lead_time)):
+            if mode == 'learn':
+                continue
+            try:
+                requests.append((chat_id, self.user_config.get_user_data(chat_id)['language'], mode))
+            except KeyError:
+                continue
+        return self.schedule_many(requests)
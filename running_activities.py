@@ -11,60 +11,55 @@ from exercise import Exercise
 class RunningActivities:
     def __init__(self, fpath):
         self.running_exercises_file = fpath
+        self._running_activities = dict()
         if os.path.exists(self.running_exercises_file):
-            self._running_activities = joblib.load(filename=self.running_exercises_file)
+            try:
+                self._running_activities = joblib.load(filename=self.running_exercises_file)
+            except Exception as e:
+                # e.g. a file truncated by an older version, the running exercises are lost
+                print(f'Could not restore running exercises: {e}')
             os.remove(self.running_exercises_file)
-        else:
-            self._running_activities = dict()
         self._lock = threading.Lock()
 
     def add_activity(self, chat_id, activity):
-        self._lock.acquire()
-        if chat_id not in self._running_activities:
-            self._running_activities[chat_id] = []
+        with self._lock:
+            if chat_id not in self._running_activities:
+                self._running_activities[chat_id] = []
 
-        if isinstance(activity, Exercise):
-            # remove all other activities
-            self._running_activities[chat_id] = []
-            self._running_activities[chat_id].append(activity) 
-        else:
-            # add a command
-            current_activity = self._running_activities[chat_id][-1] if len(self._running_activities[chat_id]) > 0 else None
-            if not isinstance(current_activity, Exercise) and current_activity is not None:
-                # remove the command that is on top of the stack
-                self._running_activities[chat_id].pop()
-            self._running_activities[chat_id].append(activity)
-        
-        assert len(self._running_activities[chat_id]) <= 2
-        self._lock.release()
+            if isinstance(activity, Exercise):
+                # remove all other activities
+                self._running_activities[chat_id] = []
+                self._running_activities[chat_id].append(activity)
+            else:
+                # add a command
+                current_activity = self._running_activities[chat_id][-1] if len(self._running_activities[chat_id]) > 0 else None
+                if not isinstance(current_activity, Exercise) and current_activity is not None:
+                    # remove the command that is on top of the stack
+                    self._running_activities[chat_id].pop()
+                self._running_activities[chat_id].append(activity)
+
+            assert len(self._running_activities[chat_id]) <= 2
 
     def pop_activity(self, chat_id):
-        self._lock.acquire()
-        if len(self._running_activities[chat_id]) > 0:
-            activity = self._running_activities[chat_id].pop()
-        self._lock.release()
+        with self._lock:
+            if len(self._running_activities[chat_id]) > 0:
+                activity = self._running_activities[chat_id].pop()
         return activity
 
     def pop_all(self, chat_id):
-        self._lock.acquire()
-        self._running_activities[chat_id] = []
-        self._lock.release()
+        with self._lock:
+            self._running_activities[chat_id] = []
 
     @property
     def chat_ids(self):
-        self._lock.acquire()
-        all_chat_ids = self._running_activities.keys()
-        self._lock.release()
-        return all_chat_ids
+        with self._lock:
+            return list(self._running_activities.keys())
 
     def current_activity(self, chat_id):
-        self._lock.acquire()
-        if chat_id not in self._running_activities or len(self._running_activities[chat_id]) == 0:
-            self._lock.release()
-            return None
-        exercise = self._running_activities[chat_id][-1]
-        self._lock.release()
-        return exercise
+        with self._lock:
+            if chat_id not in self._running_activities or len(self._running_activities[chat_id]) == 0:
+                return None
+            return self._running_activities[chat_id][-1]
     
     # def current_exercise(self, chat_id):
     #     self._lock.acquire()
@@ -77,10 +72,13 @@ class RunningActivities:
     #     return activity
 
     def backup(self):
-        self._lock.acquire()    
-        joblib.dump(self._running_activities, filename=self.running_exercises_file)
-        self._lock.release()
-
-    def release_lock(self):
-        if self._lock.locked():
-            self._lock.release()
\ No newline at end of file
+        # written to a temporary file first, so that a failed dump does not leave a broken backup
+        tmp_path = f'{self.running_exercises_file}.tmp'
+        with self._lock:
+            try:
+                joblib.dump(self._running_activities, filename=tmp_path)
+                os.replace(tmp_path, self.running_exercises_file)
+            except Exception as e:
+                print(f'Could not back up running exercises: {e}')
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
@@ -0,0 +1,191 @@
+"""Fast-forward simulation of the learning plan with synthetic users, decks and answers.
+
+Drives LearningPlan with a fake clock and a stubbed assistant, so years of history can be simulated in minutes,
+and reports latency percentiles of the planner calls and the memory used by the process. Example:
+
+    python simulate.py --users 10000 --words 5000 --deck-size 200 --days 30
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import learning_plan
+from decks_db import DecksDB
+from learning_plan import LearningPlan
+from storage import CsvStorage, SqliteStorage, csv_paths, migrate_csv_to_sqlite
+from templates import Templates
+from user_config import UserConfig
+from words_db import WordsDB
+from words_exercise import WordsExerciseLearn
+from words_progress_db import WordsProgressDB
+
+
+class SimClock:
+    def __init__(self, start: datetime):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+_generated_word_ids = itertools.count()
+
+
+async def fake_assistant_response(interface, query, uilang, model_base, model_substitute, response_format=None, validation_cls=None):
+    if validation_cls is None:
+        return ''
+    if 'deck_words' in validation_cls.model_fields:
+        return validation_cls(deck_theme='simulated', deck_words=[f'generated{next(_generated_word_ids)}' for _ in range(20)])
+    return validation_cls.model_construct()
+
+
+def make_user_data(root: Path, n_users, n_words, deck_size, lang, seed):
+    rng = np.random.default_rng(seed)
+    chat_ids = np.arange(1, n_users + 1)
+
+    pd.DataFrame(dict(id=np.arange(n_words), word=[f'word{i}' for i in range(n_words)], lang=lang, tags=np.nan,
+                      meaning=np.nan)).to_csv(root / 'words_db.csv', index=False)
+    pd.DataFrame(dict(id=chat_ids - 1, owner=chat_ids.astype(str), name='custom', language=lang,
+                      tags=np.nan)).to_csv(root / 'decks_db.csv', index=False)
+    deck_size = min(deck_size, n_words)
+    deck_words = np.concatenate([rng.choice(n_words, size=deck_size, replace=False) for _ in chat_ids])
+    pd.DataFrame(dict(deck_id=np.repeat(chat_ids - 1, deck_size), word_id=deck_words)).to_csv(root / 'deck_word.csv', index=False)
+    pd.DataFrame(columns=['chat_id', 'word_id', 'num_reps', 'e_factor', 'last_interval', 'last_review_date',
+                          'next_review_date', 'to_ignore']).to_csv(root / 'words_progress_db.csv', index=False)
+
+    schedule = dict(words=dict(weekday={'10:00': 'learn', '14:00': 'test', '18:00': 'test'},
+                               weekend={'11:00': 'learn', '16:00': 'test'}))
+    config = {str(chat_id): dict(ui_language='english', language=lang, timezone='Europe/Berlin', level='B1',
+                                 n_flashcards=5, exercise_types=['words'], schedule=schedule) for chat_id in chat_ids}
+    with open(root / 'user_config.json', 'w', encoding='utf-8') as fp:
+        json.dump(config, fp)
+    return [int(chat_id) for chat_id in chat_ids]
+
+
+class Timings:
+    def __init__(self):
+        self.samples = dict()
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def report(self):
+        print(f'{"call":<26}{"n":>9}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+        for name, samples in self.samples.items():
+            ms = np.array(samples) * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            print(f'{name:<26}{len(ms):>9}{ms.mean():>10.3f}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}{ms.max():>10.3f}')
+
+
+async def simulate(args):
+    random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    qualities = np.array([float(q) for q in args.quality_probs.split(',')])
+    qualities = qualities / qualities.sum()
+
+    root = Path(tempfile.mkdtemp(prefix='flashbot_sim_'))
+    timings = Timings()
+    try:
+        chat_ids = make_user_data(root, args.users, args.words, args.deck_size, args.lang, args.seed)
+        if args.trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        if args.backend == 'sqlite':
+            migrate_csv_to_sqlite(root, root / 'flashbot.sqlite')
+            storage = SqliteStorage(root / 'flashbot.sqlite')
+        else:
+            storage = CsvStorage(csv_paths(root))
+        words_progress_db = WordsProgressDB(storage)
+        clock = SimClock(datetime.strptime(args.start, '%Y-%m-%d'))
+        with open(Path('resources') / 'interface.json', encoding='utf-8') as fp:
+            interface = json.load(fp)
+        lp = LearningPlan(interface, Templates(Path('resources') / 'templates'), words_progress_db=words_progress_db,
+                          words_db=WordsDB(storage), decks_db=DecksDB(storage), user_config=UserConfig(root / 'user_config.json'),
+                          clock=clock)
+        print(f'Loaded {args.users} users, {args.words} words in {time.perf_counter() - start:.2f} s')
+
+        for day in range(args.days):
+            day_start = time.perf_counter()
+            clock.now = datetime.strptime(args.start, '%Y-%m-%d') + timedelta(days=day, hours=0, minutes=1)
+            t = time.perf_counter()
+            lp.reset_long_due_words()
+            timings.add('reset_long_due_words', time.perf_counter() - t)
+
+            for session in range(args.sessions_per_day):
+                clock.now = clock.now.replace(hour=9 + 3 * session, minute=0)
+                for chat_id in chat_ids:
+                    clock.now += timedelta(microseconds=1)
+
+                    t = time.perf_counter()
+                    lp.get_due_today(chat_id, args.lang)
+                    timings.add('get_due_today', time.perf_counter() - t)
+
+                    # the first session of a day learns new words like the scheduled 'learn' pings
+                    mode = 'learn' if session == 0 else None
+                    for _ in range(args.exercises_per_session):
+                        t = time.perf_counter()
+                        exercise = await lp.get_next_words_exercise(chat_id, args.lang, mode)
+                        timings.add('get_next_words_exercise', time.perf_counter() - t)
+                        if exercise is None:
+                            break
+
+                        quality = None if isinstance(exercise, WordsExerciseLearn) else int(rng.choice(6, p=qualities))
+                        t = time.perf_counter()
+                        lp.process_response(chat_id, exercise, quality)
+                        timings.add('process_response', time.perf_counter() - t)
+
+                        t = time.perf_counter()
+                        words_progress_db.save_progress()
+                        timings.add('save_progress', time.perf_counter() - t)
+
+            t = time.perf_counter()
+            words_progress_db.compact()
+            timings.add('compact', time.perf_counter() - t)
+            print(f'Day {day + 1}/{args.days} ({clock.now.date()}): {len(words_progress_db)} progress rows, '
+                  f'{time.perf_counter() - day_start:.2f} s')
+
+        timings.report()
+        if args.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            print(f'Python memory: current {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB')
+        try:
+            import resource
+            print(f'Max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10:.1f} MiB')
+        except ImportError:
+            pass
+        storage.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate users of the learning plan and report latencies of planner calls.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--words', type=int, default=5000)
+    parser.add_argument('--deck-size', type=int, default=200, help='number of words in the deck of every user')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--sessions-per-day', type=int, default=3)
+    parser.add_argument('--exercises-per-session', type=int, default=3)
+    parser.add_argument('--quality-probs', default='0.05,0.05,0.1,0.2,0.3,0.3', help='probabilities of answer qualities 0..5')
+    parser.add_argument('--lang', default='spanish')
+    parser.add_argument('--start', default='2026-01-05', help='first simulated day')
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true', help='trace python allocations, slows down the simulation')
+    args = parser.parse_args()
+
+    # the assistant is never called, new words are made up
+    learning_plan.get_assistant_response = fake_assistant_response
+    asyncio.run(simulate(args))
@@ -0,0 +1,366 @@
+import abc
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import sqlite3
+import threading
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+TABLE_COLUMNS = {
+    'words': ['id', 'word', 'lang', 'tags', 'meaning'],
+    'decks': ['id', 'owner', 'name', 'language', 'tags'],
+    'deck_word': ['deck_id', 'word_id'],
+    'progress': ['chat_id', 'word_id', 'num_reps', 'e_factor', 'last_interval', 'last_review_date', 'next_review_date', 'to_ignore'],
+}
+
+# columns that identify a row, tables without a key only support inserts
+TABLE_KEYS = {
+    'words': ['id'],
+    'decks': ['id'],
+    'deck_word': None,
+    'progress': ['chat_id', 'word_id'],
+}
+
+
+def _to_record_value(value):
+    # converts a value of a DataFrame cell into something that can be stored as json or in sqlite
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, (float, np.floating)) and math.isnan(value):
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _key(values):
+    return tuple(int(v) for v in values)
+
+
+class Storage(abc.ABC):
+    """Persistence backend of WordsDB, DecksDB and WordsProgressDB.
+
+    The stores keep their tables in memory and report every change to the backend, which decides
+    when and how the change reaches the disk.
+    """
+
+    @abc.abstractmethod
+    def load(self, table: str) -> pd.DataFrame:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert(self, table: str, row: dict) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update(self, table: str, key: dict, values: dict) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, table: str, key: dict) -> None:
+        """Deletes rows matching the key, a list as a key value matches any of its elements."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def commit(self, table: str, df: pd.DataFrame) -> None:
+        """Makes all the changes of the table durable, df is the current in-memory state of the table."""
+        raise NotImplementedError
+
+    def rotate(self, table: str) -> None:
+        """Starts a compaction of the table, called together with taking the snapshot that is passed to compact."""
+        pass
+
+    def compact(self, table: str, df: pd.DataFrame) -> None:
+        """Writes df, the state of the table at the last rotate, changes reported since then are kept.
+
+        Can be called without the lock of the store, while other changes are reported.
+        """
+        self.commit(table, df)
+
+    def close(self) -> None:
+        pass
+
+
+class CsvStorage(Storage):
+    """Keeps every table in a CSV file.
+
+    Tables listed in `journaled` are written as a snapshot plus an append-only journal of changes,
+    the other tables are rewritten as a whole on every commit. A read_only storage replays the journals
+    on load but never creates or writes them.
+    """
+
+    def __init__(self, paths: dict, journaled=('progress',), read_only=False):
+        self.paths = {table: str(path) for table, path in paths.items()}
+        self.journaled = set(journaled)
+        self.read_only = read_only
+        self._journals = dict()
+        self._lock = threading.Lock()
+
+    def _journal_path(self, table):
+        return f'{self.paths[table]}.journal'
+
+    def _rotated_journal_path(self, table):
+        # changes before the snapshot that is being written by compact
+        return f'{self.paths[table]}.journal.old'
+
+    def load(self, table: str) -> pd.DataFrame:
+        path = self.paths[table]
+        df = pd.read_csv(path) if os.path.exists(path) else pd.DataFrame(columns=TABLE_COLUMNS[table])
+        if table in self.journaled:
+            # the rotated journal is left if a compaction did not finish, its changes may already be in the snapshot
+            df = self._replay_journal(self._rotated_journal_path(table), table, df, ignore_missing=True)
+            df = self._replay_journal(self._journal_path(table), table, df)
+            if not self.read_only:
+                self._journals[table] = open(self._journal_path(table), 'a', encoding='utf-8')
+        return df
+
+    def _replay_journal(self, journal_path, table, df, ignore_missing=False):
+        # with ignore_missing the journal can be replayed onto a snapshot that already contains its changes, the
+        # updates of rows that were deleted later are skipped then
+        if not os.path.exists(journal_path):
+            return df
+        with open(journal_path, 'r', encoding='utf-8') as fp:
+            lines = fp.readlines()
+        if len(lines) == 0:
+            return df
+
+        key_cols = TABLE_KEYS[table]
+        rows = {_key(row[c] for c in key_cols): row for row in df.to_dict('records')}
+        for i, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                if i == len(lines) - 1:
+                    # the last record was not fully written before a crash
+                    print(f'Skipping a truncated record at the end of {journal_path}')
+                    break
+                raise
+            op = record['op']
+            if op == 'insert':
+                rows[_key(record['row'][c] for c in key_cols)] = record['row']
+            elif op == 'update':
+                key = _key(record['key'][c] for c in key_cols)
+                if key in rows or not ignore_missing:
+                    rows[key].update(record['values'])
+            elif op == 'delete':
+                key_values = [v if isinstance(v, list) else [v] for v in (record['key'][c] for c in key_cols)]
+                for k in itertools.product(*key_values):
+                    rows.pop(_key(k), None)
+            else:
+                raise ValueError(f'Unknown journal operation {op}.')
+        print(f'Replayed {len(lines)} records from {journal_path}')
+        return pd.DataFrame(list(rows.values()), columns=df.columns)
+
+    def _log(self, table, record):
+        if table not in self.journaled:
+            # the table is rewritten on commit
+            return
+        with self._lock:
+            self._journals[table].write(json.dumps(record) + '\n')
+
+    def insert(self, table: str, row: dict) -> None:
+        self._log(table, dict(op='insert', row={k: _to_record_value(v) for k, v in row.items()}))
+
+    def update(self, table: str, key: dict, values: dict) -> None:
+        self._log(table, dict(op='update', key={k: _to_record_value(v) for k, v in key.items()},
+                              values={k: _to_record_value(v) for k, v in values.items()}))
+
+    def delete(self, table: str, key: dict) -> None:
+        key = {k: [_to_record_value(x) for x in v] if isinstance(v, (list, tuple)) else _to_record_value(v) for k, v in key.items()}
+        self._log(table, dict(op='delete', key=key))
+
+    def commit(self, table: str, df: pd.DataFrame) -> None:
+        if table in self.journaled:
+            with self._lock:
+                self._journals[table].flush()
+                os.fsync(self._journals[table].fileno())
+        else:
+            df.to_csv(self.paths[table], index=False)
+
+    def rotate(self, table: str) -> None:
+        if table not in self.journaled:
+            return
+        # the changes so far are moved to the rotated journal, they are dropped when the snapshot is written
+        with self._lock:
+            self._journals[table].close()
+            rotated_path = self._rotated_journal_path(table)
+            if os.path.exists(rotated_path):
+                # the last compaction did not finish, its changes are still needed
+                with open(rotated_path, 'a', encoding='utf-8') as rotated, \
+                        open(self._journal_path(table), 'r', encoding='utf-8') as journal:
+                    shutil.copyfileobj(journal, rotated)
+                os.remove(self._journal_path(table))
+            else:
+                os.replace(self._journal_path(table), rotated_path)
+            self._journals[table] = open(self._journal_path(table), 'w', encoding='utf-8')
+
+    def compact(self, table: str, df: pd.DataFrame) -> None:
+        if table not in self.journaled:
+            self.commit(table, df)
+            return
+        tmp_path = f'{self.paths[table]}.tmp'
+        df.to_csv(tmp_path, index=False)
+        with open(tmp_path, 'rb') as fp:
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.paths[table])
+        os.remove(self._rotated_journal_path(table))
+
+    def close(self) -> None:
+        for journal in self._journals.values():
+            journal.close()
+
+
+class SqliteStorage(Storage):
+    """Keeps all tables in a single sqlite database, every change is a row-level statement.
+
+    The database is only written to and read at load, the stores still keep whole tables in memory. Only the keys
+    that the updates and deletes look up are indexed.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS words (id INTEGER PRIMARY KEY, word TEXT NOT NULL, lang TEXT NOT NULL, tags TEXT, meaning TEXT)',
+        'CREATE TABLE IF NOT EXISTS decks (id INTEGER PRIMARY KEY, owner TEXT NOT NULL, name TEXT NOT NULL, language TEXT NOT NULL, tags TEXT)',
+        'CREATE TABLE IF NOT EXISTS deck_word (deck_id INTEGER NOT NULL, word_id INTEGER NOT NULL)',
+        # created by earlier versions, no query used them
+        'DROP INDEX IF EXISTS words_lang_word',
+        'DROP INDEX IF EXISTS decks_owner_language',
+        'DROP INDEX IF EXISTS deck_word_deck',
+        'CREATE TABLE IF NOT EXISTS progress (chat_id INTEGER NOT NULL, word_id INTEGER NOT NULL, num_reps REAL, e_factor REAL, '
+        'last_interval INTEGER, last_review_date TEXT, next_review_date TEXT, to_ignore INTEGER NOT NULL DEFAULT 0)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS progress_chat_word ON progress(chat_id, word_id)',
+    ]
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            self._conn.execute(query, params)
+
+    def load(self, table: str) -> pd.DataFrame:
+        with self._lock:
+            df = pd.read_sql_query(f'SELECT {", ".join(TABLE_COLUMNS[table])} FROM {table}', self._conn)
+        if table == 'progress':
+            df['to_ignore'] = df['to_ignore'].astype(bool)
+        return df
+
+    def insert(self, table: str, row: dict) -> None:
+        cols = list(row.keys())
+        self._execute(f'INSERT INTO {table} ({", ".join(cols)}) VALUES ({", ".join("?" * len(cols))})',
+                      [_to_record_value(row[c]) for c in cols])
+
+    def update(self, table: str, key: dict, values: dict) -> None:
+        set_clause = ', '.join(f'{c} = ?' for c in values.keys())
+        where_clause = ' AND '.join(f'{c} = ?' for c in key.keys())
+        self._execute(f'UPDATE {table} SET {set_clause} WHERE {where_clause}',
+                      [_to_record_value(v) for v in values.values()] + [_to_record_value(v) for v in key.values()])
+
+    def delete(self, table: str, key: dict) -> None:
+        conditions = []
+        params = []
+        for c, v in key.items():
+            if isinstance(v, (list, tuple)):
+                conditions.append(f'{c} IN ({", ".join("?" * len(v))})')
+                params.extend(_to_record_value(x) for x in v)
+            else:
+                conditions.append(f'{c} = ?')
+                params.append(_to_record_value(v))
+        self._execute(f'DELETE FROM {table} WHERE {" AND ".join(conditions)}', params)
+
+    def commit(self, table: str, df: pd.DataFrame) -> None:
+        with self._lock:
+            self._conn.commit()
+
+    def rotate(self, table: str) -> None:
+        with self._lock:
+            self._conn.commit()
+
+    def compact(self, table: str, df: pd.DataFrame) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def csv_paths(user_data_root) -> dict:
+    user_data_root = Path(user_data_root)
+    return {
+        'words': user_data_root / 'words_db.csv',
+        'decks': user_data_root / 'decks_db.csv',
+        'deck_word': user_data_root / 'deck_word.csv',
+        'progress': user_data_root / 'words_progress_db.csv',
+    }
+
+
+def _remove_db_files(db_path):
+    for path in [db_path, f'{db_path}-wal', f'{db_path}-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def migrate_csv_to_sqlite(user_data_root, db_path):
+    """Copies all tables from the CSV layout in user_data_root into a new sqlite database.
+
+    The database is written to a temporary file that is renamed to db_path only if all tables were copied, so a
+    failed migration can be run again. The CSV files and their journals are not modified.
+    """
+    db_path = str(db_path)
+    if os.path.exists(db_path):
+        raise ValueError(f'Database {db_path} already exists.')
+    tmp_path = f'{db_path}.tmp'
+    # left over by a failed migration
+    _remove_db_files(tmp_path)
+
+    csv_storage = CsvStorage(csv_paths(user_data_root), read_only=True)
+    sqlite_storage = SqliteStorage(tmp_path)
+    try:
+        for table, columns in TABLE_COLUMNS.items():
+            df = csv_storage.load(table)
+            for c in columns:
+                if c not in df.columns:
+                    df[c] = None
+            if table == 'progress':
+                df['to_ignore'] = df['to_ignore'].fillna(False).astype(bool)
+            rows = [[_to_record_value(v) for v in row] for row in df[columns].itertuples(index=False)]
+            sqlite_storage._conn.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+            print(f'Migrated {len(rows)} rows of {table}')
+        sqlite_storage._conn.commit()
+    except BaseException:
+        sqlite_storage.close()
+        _remove_db_files(tmp_path)
+        raise
+    finally:
+        csv_storage.close()
+    # closing the last connection checkpoints the WAL into the database file
+    sqlite_storage.close()
+    os.replace(tmp_path, db_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the CSV databases into a sqlite database.')
+    parser.add_argument('--user-data-root', default='resources')
+    parser.add_argument('--db-path', default=None)
+    args = parser.parse_args()
+    db_path = Path(args.user_data_root) / 'flashbot.sqlite' if args.db_path is None else args.db_path
+    migrate_csv_to_sqlite(args.user_data_root, db_path)
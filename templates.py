@@ -1,36 +1,85 @@
 import os
 
+import jinja2
+
 
 class Templates:
+    """Jinja templates of the messages and queries, compiled once when they are loaded.
+
+    A template that does not compile raises at load, not when it is first used.
+    """
+
     def __init__(self, path):
-        self._templates = dict()
+        self.path = path
+        self._sources = self._load()
+        self._templates = self._compile_all(self._sources)
+
+    def __getstate__(self):
+        # compiled templates cannot be pickled, exercises holding the templates are pickled by RunningActivities.backup
+        return dict(path=self.path, _sources=self._sources)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._templates = self._compile_all(self._sources)
+
+    @staticmethod
+    def _compile_all(sources):
+        # sources are nested like the templates, the leaves are (path, source)
+        env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+
+        def compile_dict(items):
+            res = dict()
+            for name, item in items.items():
+                if isinstance(item, dict):
+                    res[name] = compile_dict(item)
+                    continue
+                template_path, source = item
+                try:
+                    res[name] = env.from_string(source)
+                except jinja2.TemplateSyntaxError as e:
+                    raise ValueError(f'Could not compile template {template_path}: {e}') from e
+            return res
+
+        return compile_dict(sources)
+
+    @staticmethod
+    def _read(template_path):
+        with open(template_path, 'r', encoding='utf-8') as file:
+            return template_path, file.read()
+
+    def _load(self):
+        templates = dict()
 
-        for lang in os.listdir(path):
-            lang_path = os.path.join(path, lang)
+        for lang in os.listdir(self.path):
+            lang_path = os.path.join(self.path, lang)
 
             if os.path.isdir(lang_path):
-                self._templates[lang] = {}
+                templates[lang] = {}
 
                 for item in os.listdir(lang_path):
 
                     template_path = os.path.join(lang_path, item)
 
                     if os.path.isfile(template_path):
-                        with open(template_path, 'r', encoding='utf-8') as file:
-                            tname = os.path.splitext(item)[0]
-                            self._templates[lang][tname] = file.read()
+                        tname = os.path.splitext(item)[0]
+                        templates[lang][tname] = self._read(template_path)
                     else:
                         dst_lang = item
-                        self._templates[lang][dst_lang] = {}
+                        templates[lang][dst_lang] = {}
                         for tname in os.listdir(template_path):
                             tpath = os.path.join(lang_path, dst_lang, tname)
                             if os.path.isfile(tpath):
-                                with open(tpath, 'r', encoding='utf-8') as file:
-                                    tfilename = os.path.splitext(tname)[0]
-                                    self._templates[lang][dst_lang][tfilename] = file.read()
+                                tfilename = os.path.splitext(tname)[0]
+                                templates[lang][dst_lang][tfilename] = self._read(tpath)
+        return templates
 
+    def reload(self) -> None:
+        # the templates are replaced only if all of them compile
+        sources = self._load()
+        self._templates = self._compile_all(sources)
+        self._sources = sources
 
-    def get_template(self, uilang: str, lang: str, template_name: str) -> str:
+    def get_template(self, uilang: str, lang: str, template_name: str) -> jinja2.Template:
         template = self._templates[uilang][template_name] if template_name in self._templates[uilang].keys() else \
                                 self._templates[uilang][lang][template_name]
-        return template
\ No newline at end of file
+        return template
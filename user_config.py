@@ -28,26 +28,20 @@ class UserConfig:
         self._lock = threading.Lock()
 
     def get_all_user_data(self):
-        self._lock.acquire()
-        ud_cpy = copy.deepcopy(self._user_data)
-        self._lock.release()
-        return ud_cpy
+        with self._lock:
+            return copy.deepcopy(self._user_data)
 
     def get_all_chat_ids(self):
-        self._lock.acquire()
-        chat_ids = list(self._user_data.keys())
-        self._lock.release()
-        return chat_ids
+        with self._lock:
+            return list(self._user_data.keys())
 
     def get_user_data(self, chat_id):
-        self._lock.acquire()
-        ud_cpy = copy.deepcopy(self._user_data[chat_id])
-        self._lock.release()
-        return ud_cpy
+        with self._lock:
+            return copy.deepcopy(self._user_data[chat_id])
+
+    def get_user_timezone(self, chat_id):
+        # users missing from the config are assumed to live in the timezone of the server
+        return ZoneInfo(self._user_data[chat_id]['timezone']) if chat_id in self._user_data else datetime.now().astimezone().tzinfo
 
     def get_user_ui_lang(self, chat_id):
         return self._user_data[chat_id]['ui_language'] if 'ui_language' in self._user_data[chat_id].keys() else 'english'
-
-    def release_lock(self):
-        if self._lock.locked():
-            self._lock.release()
\ No newline at end of file
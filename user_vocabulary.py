@@ -0,0 +1,63 @@
+from typing import List, Optional
+
+import pandas as pd
+
+from due_queue import DueQueue
+
+
+def is_ignored(progress: dict) -> bool:
+    return pd.notna(progress['to_ignore']) and bool(progress['to_ignore'])
+
+
+class UserVocabulary:
+    """Words of a user's decks in one language joined with the user's progress on them.
+
+    The view is built once from the tables and then patched on every change of the user's decks or progress,
+    so that planner queries depend only on the size of the user's vocabulary.
+    """
+
+    def __init__(self, chat_id, lang, max_n_reps):
+        self.chat_id = chat_id
+        self.lang = lang
+        self.max_n_reps = max_n_reps
+        self.deck_words = dict()  # word_id -> (word, meaning) of words in the user's decks
+        self.n_deck_links = 0  # number of (deck, word) pairs in the user's decks
+        self.progress = dict()  # word_id -> progress of the user on any word of the language, with the word under 'word'
+        self.due_queue = DueQueue(max_n_reps)
+
+    def add_deck_word(self, word_id: int, word: Optional[str], meaning) -> None:
+        # word is None if the word is in another language
+        self.n_deck_links += 1
+        if word is not None:
+            self.deck_words[word_id] = (word, meaning)
+            self._update_due_queue(word_id)
+
+    def set_progress(self, word_id: int, word: str, progress: Optional[dict]) -> None:
+        if progress is None:
+            self.progress.pop(word_id, None)
+        else:
+            self.progress[word_id] = dict(progress, word=word)
+        self._update_due_queue(word_id)
+
+    def _update_due_queue(self, word_id):
+        progress = self.progress.get(word_id)
+        if word_id not in self.deck_words or progress is None or is_ignored(progress):
+            self.due_queue.remove(word_id)
+        else:
+            self.due_queue.update(word_id, self.deck_words[word_id][0], progress['next_review_date'], progress['num_reps'])
+
+    def known_words(self) -> List[str]:
+        return [progress['word'] for progress in self.progress.values() if not is_ignored(progress)]
+
+    def learn_candidates(self) -> tuple[List[int], List[int]]:
+        """Returns ids of unseen deck words and of all deck words that are not ignored."""
+        candidates = []
+        unseen = []
+        for word_id in self.deck_words.keys():
+            progress = self.progress.get(word_id)
+            if progress is not None and is_ignored(progress):
+                continue
+            candidates.append(word_id)
+            if progress is None or pd.isna(progress['next_review_date']):
+                unseen.append(word_id)
+        return unseen, candidates
@@ -1,81 +1,320 @@
+import asyncio
 import base64
+import contextlib
+import functools
 import os
 from pathlib import Path
-import time
+from typing import Callable, Optional
+import httpx
 import openai
 
+from llm_cache import ResponseCache
+from llm_scheduler import LLMScheduler, llm_priority
+from model_router import ModelRouter
+from partial_json import parse_partial_json
 
-async def get_assistant_response(interface, query, uilang, model_base, model_substitute, response_format=None, validation_cls=None):
 
+# the client is shared by all requests of the process so that connections to the API are reused
+_openai_client = None
+# responses to generation queries shared between users, disabled until init_response_cache is called
+_response_cache = None
+# (key, priority, max_tokens, streamed) of a request -> (task of the request that is being sent to the API,
+# _PartialFanout of a streamed request or None)
+_in_flight = dict()
+# rate and concurrency limits of requests to the API, not limited until init_llm_scheduler is called
+_llm_scheduler = None
+# failover between the base and the substitute model
+_model_router = ModelRouter()
+
+
+def _read_openai_key():
     openai_key = os.getenv('OPENAI_KEY')
     if openai_key is None:
         with open(Path('api_keys/openai_api.txt'), 'r') as fp:
                 lines = fp.readlines()
                 openai_key = lines[0].strip()
-    client = openai.OpenAI(api_key=openai_key, timeout=20.0, max_retries=0)
+    return openai_key
+
+
+def init_openai_client():
+    """Creates the shared async client, should be called once at startup from the running event loop."""
+    global _openai_client
+    max_connections = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+    http_client = openai.DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=max_connections,
+                                                                      max_keepalive_connections=max_connections))
+    _openai_client = openai.AsyncOpenAI(api_key=_read_openai_key(), timeout=20.0, max_retries=0, http_client=http_client)
+    return _openai_client
+
+
+def get_openai_client():
+    if _openai_client is None:
+        init_openai_client()
+    return _openai_client
+
+
+async def close_openai_client():
+    global _openai_client
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+
+
+def init_response_cache(db_path, **kwargs):
+    global _response_cache
+    _response_cache = ResponseCache(db_path, **kwargs)
+    return _response_cache
+
+
+def close_response_cache():
+    global _response_cache
+    if _response_cache is not None:
+        _response_cache.close()
+        _response_cache = None
+
+
+def init_llm_scheduler(**kwargs):
+    global _llm_scheduler
+    _llm_scheduler = LLMScheduler(**kwargs)
+    return _llm_scheduler
+
+
+def get_llm_scheduler():
+    return _llm_scheduler
+
+
+def init_model_router(**kwargs):
+    global _model_router
+    _model_router = ModelRouter(**kwargs)
+    return _model_router
+
+
+def get_model_router():
+    return _model_router
+
+
+def _llm_slot(tokens):
+    if _llm_scheduler is None:
+        return contextlib.nullcontext(dict(used_tokens=None))
+    return _llm_scheduler.slot(tokens)
+
+
+@functools.lru_cache(maxsize=None)
+def get_response_format(validation_cls, name='word_example') -> dict:
+    """Returns the strict JSON schema response format of a pydantic schema, built once per schema.
+
+    The returned dict is shared and must not be modified.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {"strict": True,
+                        "name": name,
+                        "schema": validation_cls.model_json_schema()
+                        }
+    }
+
+
+def _schema_name(response_format, validation_cls):
+    if validation_cls is not None:
+        return validation_cls.__name__
+    if response_format is not None and 'json_schema' in response_format:
+        return response_format['json_schema']['schema'].get('title', response_format['json_schema']['name'])
+    return None
+
+
+class _PartialFanout:
+    """Passes the partial responses of a shared streamed request to the callbacks of all of its callers."""
+
+    def __init__(self):
+        self.callbacks = []
+        self.last = None
+
+    def add(self, callback):
+        self.callbacks.append(callback)
+        if self.last is not None:
+            # partial responses contain all fields known so far, a caller that joins late catches up with the last one
+            self._call(callback, self.last)
+
+    def __call__(self, partial):
+        self.last = partial
+        for callback in list(self.callbacks):
+            self._call(callback, partial)
+
+    @staticmethod
+    def _call(callback, partial):
+        try:
+            callback(partial)
+        except Exception as e:
+            # a partial response is only a preview, the complete one is still returned
+            print(f'Could not show a partial response: {e}')
+
+
+def _forget_request(flight_key, task):
+    # done callback of an in-flight request
+    if flight_key in _in_flight and _in_flight[flight_key][0] is task:
+        del _in_flight[flight_key]
+    if not task.cancelled():
+        # the exception is raised in the waiters, this only marks it as retrieved if nobody waits anymore
+        task.exception()
+
+
+async def get_assistant_response(interface, query, uilang, model_base, model_substitute, response_format=None, validation_cls=None,
+                                 use_cache=False, max_tokens=600, on_partial: Optional[Callable[[dict], None]] = None):
+    # use_cache should only be set for queries whose answer does not depend on the user, e.g. generated examples
+    # on_partial streams the response, it is called with the fields of the JSON response known so far
+
+    key = ResponseCache.make_key(query, uilang, _schema_name(response_format, validation_cls), model_base)
+    use_cache = use_cache and _response_cache is not None
+    if use_cache:
+        # the cache reads sqlite on a miss of its memory tier, it is called in a worker thread
+        content = await asyncio.to_thread(_response_cache.get, key)
+        if content is not None:
+            return validation_cls.model_validate_json(content) if validation_cls is not None else content
+
+    # identical concurrent requests of the same priority and length share one call to the API. The task is admitted
+    # by the scheduler at the priority of its creator, so an interactive request never waits for a background one.
+    # Streamed requests are only shared with streamed ones, their partial responses are passed to every caller.
+    flight_key = (key, llm_priority.get(), max_tokens, on_partial is not None)
+    if flight_key in _in_flight:
+        task, fanout = _in_flight[flight_key]
+    else:
+        fanout = _PartialFanout() if on_partial is not None else None
+        task = asyncio.ensure_future(_request_assistant(interface, query, uilang, model_base, model_substitute, response_format, max_tokens,
+                                                        cache_key=key if use_cache else None, on_partial=fanout))
+        _in_flight[flight_key] = (task, fanout)
+        task.add_done_callback(lambda done_task: _forget_request(flight_key, done_task))
+    if fanout is not None:
+        fanout.add(on_partial)
+    try:
+        # a cancelled caller must not cancel the request of the others
+        content = await asyncio.shield(task)
+    finally:
+        if fanout is not None:
+            fanout.callbacks.remove(on_partial)
+
+    if validation_cls is not None:
+        validated_resp = validation_cls.model_validate_json(content)
+    else:
+        validated_resp = content
+
+    return validated_resp
+
+
+async def _request_assistant(interface, query, uilang, model_base, model_substitute, response_format, max_tokens, cache_key=None,
+                             on_partial=None) -> str:
+
+    client = get_openai_client()
 
     nattempts = 0
     messages = [
                 {"role": "system", "content": interface["You are a great language teacher"][uilang]},
                 {"role": "user", "content": query},
             ]
-    model = model_base
+    # rough estimate of prompt tokens, the limit on the response is counted in full
+    estimated_tokens = sum(len(message['content']) for message in messages) // 4 + max_tokens
+
+    # model whose stream is shown, a hedged request must not interleave the partial responses of two models
+    streaming_model = None
+
+    async def send(model):
+        # returns the content and the refusal of the response
+        async with _llm_slot(estimated_tokens) as usage:
+            print(f'Sending a request to chatgpt ({model})...')
+            if on_partial is None:
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    response_format=response_format
+                )
+                if response.usage is not None:
+                    usage['used_tokens'] = response.usage.total_tokens
+                return response.choices[0].message.content, response.choices[0].message.refusal
+
+            return await stream(model, usage)
+
+    async def stream(model, usage):
+        nonlocal streaming_model
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            response_format=response_format,
+            stream=True,
+            stream_options={'include_usage': True}
+        )
+        content = []
+        refusal = []
+        last_partial = None
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage['used_tokens'] = chunk.usage.total_tokens
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.refusal:
+                refusal.append(delta.refusal)
+            if not delta.content:
+                continue
+            content.append(delta.content)
+            if streaming_model is None:
+                streaming_model = model
+            if streaming_model != model:
+                continue
+            partial = parse_partial_json(''.join(content))
+            if partial is not None and partial != last_partial:
+                last_partial = partial
+                on_partial(partial)
+        return ''.join(content), ''.join(refusal) or None
+
+    response = None
     max_attempts = 3
     while nattempts < max_attempts:
         nattempts += 1
         try:
-            print(f'Sending a request to chatgpt ({model})...')
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=600,
-                response_format=response_format
-            )
+            # a slow or failing base model is hedged with the substitute
+            response = await _model_router.run(model_base, model_substitute, send)
             break
         except openai.OpenAIError as e:
             print(e)
-            time.sleep(nattempts)
-        if nattempts == max_attempts - 1:
-            model = model_substitute
+            if isinstance(e, openai.RateLimitError) and _llm_scheduler is not None:
+                try:
+                    retry_after = float(e.response.headers.get('retry-after', nattempts))
+                except ValueError:
+                    retry_after = nattempts
+                _llm_scheduler.pause(retry_after)
+            await asyncio.sleep(nattempts)
     print('Done.')
 
-    if nattempts == 3:
+    if response is None:
         print('The assistant raised an error.')
         raise ValueError('The model could not respond in required format')
-    if response.choices[0].message.refusal:
+    content, refusal = response
+    if refusal:
         print('The assistant refused to respond.')
         raise ValueError('The model refused to respond')
 
-    if validation_cls is not None:
-        validated_resp = validation_cls.model_validate_json(response.choices[0].message.content)
-    else:
-        validated_resp = response.choices[0].message.content
+    if cache_key is not None and _response_cache is not None:
+        await asyncio.to_thread(_response_cache.put, cache_key, content)
 
-    return validated_resp
+    return content
 
 
-def get_audio(query, lang, file_path):
+async def get_audio(query, lang, voice='alloy', audio_format='wav') -> bytes:
+    """Returns the pronunciation of query generated by the audio model."""
+    client = get_openai_client()
 
-    openai_key = os.getenv('OPENAI_KEY')
-    if openai_key is None:
-        with open(Path('api_keys/openai_api.txt'), 'r') as fp:
-                lines = fp.readlines()
-                openai_key = lines[0].strip()
-    client = openai.OpenAI(api_key=openai_key, timeout=20.0, max_retries=0)
-
-    completion = client.chat.completions.create(
-        model="gpt-4o-audio-preview",
-        modalities=["text", "audio"],
-        audio={"voice": "alloy", "format": "wav"},
-        messages=[
-            {
-                "role": "user",
-                "content": f'Pronounce this phrase {lang}: {query}'
-            }
-        ]
-    )
-
-    wav_bytes = base64.b64decode(completion.choices[0].message.audio.data)
-    with open(file_path, "wb") as f:
-        f.write(wav_bytes)
+    # the audio counts against the same limits as the other requests, its length is roughly bounded by the text
+    async with _llm_slot(len(query) // 4 + 200):
+        completion = await client.chat.completions.create(
+            model="gpt-4o-audio-preview",
+            modalities=["text", "audio"],
+            audio={"voice": voice, "format": audio_format},
+            messages=[
+                {
+                    "role": "user",
+                    "content": f'Pronounce this phrase {lang}: {query}'
+                }
+            ]
+        )
 
+    return base64.b64decode(completion.choices[0].message.audio.data)
@@ -5,46 +5,67 @@ import pandas as pd
 
 
 class WordsDB:
-    def __init__(self, db_path):
-        self.db_path = db_path
-        self.words_df = pd.read_csv(self.db_path)
+    def __init__(self, storage):
+        self.storage = storage
+        self.words_df = self.storage.load('words')
         self.words_df['id'] = self.words_df['id'].astype(int)
         if not self.words_df['id'].is_unique:
             raise ValueError('"id" field in the words database is not unique.')
+        self._id_index = dict(zip(self.words_df['id'], self.words_df.index))
+        # readers share a snapshot of words_df, published once by every change. It is a shallow copy, copy on write
+        # keeps it unchanged by the later changes of words_df.
+        self.version = 0
+        self._snapshot = self.words_df.copy(deep=False)
         self._lock = threading.Lock()
 
     def save_words_db(self):
-        self._lock.acquire()
-        self.words_df.to_csv(self.db_path, index=False)
-        self._lock.release()
+        with self._lock:
+            self.storage.commit('words', self.words_df)
 
     def get_words_df(self):
-        self._lock.acquire()
-        wdf_cpy = self.words_df.copy()
-        self._lock.release()
-        return wdf_cpy
+        # the returned DataFrame is shared between callers and must not be modified
+        with self._lock:
+            snapshot = self._snapshot
+        return snapshot
+
+    def get_word_by_id(self, word_id):
+        with self._lock:
+            label = self._id_index.get(int(word_id))
+            res = None if label is None else self.words_df.loc[label].to_dict()
+        return res
 
     def get_word_data(self, word, lang):
-        self._lock.acquire()
-        res = self.words_df.loc[(self.words_df['word'] == word) & (self.words_df['lang'] == lang)].to_dict()
-        self._lock.release()
+        with self._lock:
+            res = self.words_df.loc[(self.words_df['word'] == word) & (self.words_df['lang'] == lang)].to_dict()
         return res
 
     def add_new_word(self, word, lang):
-        self._lock.acquire()
-        word_data = self.words_df.loc[(self.words_df['lang'] == lang) & (self.words_df['word'] == word)]
-        if word_data.shape[0] == 0:
-            word_id = int(self.words_df['id'].max() + 1)
-            self.words_df.loc[len(self.words_df)] = {'id': word_id, 'word': word,
-                                                     'lang': lang, 'tags': np.nan}
-        elif word_data.shape[0] == 1:
-            word_id = int(word_data['id'].item())
-        else:
-            self._lock.release()
-            raise ValueError(f'The same word "{word}" appears >1 time in the database: {word_data}')
-        self._lock.release()
-        return word_id
-
-    def release_lock(self):
-        if self._lock.locked():
-            self._lock.release()
+        return self.add_new_words([word], lang)[0]
+
+    def add_new_words(self, words, lang) -> list:
+        # returns the ids of words, the words that are not in the database yet are added with a single change of words_df
+        with self._lock:
+            word_ids = []
+            new_words = dict()
+            next_id = int(self.words_df['id'].max() + 1) if len(self.words_df) > 0 else 0
+            for word in words:
+                word_data = self.words_df.loc[(self.words_df['lang'] == lang) & (self.words_df['word'] == word)]
+                if word_data.shape[0] > 1:
+                    raise ValueError(f'The same word "{word}" appears >1 time in the database: {word_data}')
+                if word_data.shape[0] == 1:
+                    word_ids.append(int(word_data['id'].item()))
+                    continue
+                if word not in new_words:
+                    new_words[word] = {'id': next_id, 'word': word, 'lang': lang, 'tags': np.nan}
+                    next_id += 1
+                word_ids.append(new_words[word]['id'])
+
+            if len(new_words) > 0:
+                labels = range(len(self.words_df), len(self.words_df) + len(new_words))
+                self.words_df = pd.concat([self.words_df, pd.DataFrame(list(new_words.values()), index=labels)])
+                for label, new_word in zip(labels, new_words.values()):
+                    self._id_index[new_word['id']] = label
+                    self.storage.insert('words', new_word)
+                self.version += 1
+                self._snapshot = self.words_df.copy(deep=False)
+        return word_ids
@@ -1,10 +1,14 @@
+import asyncio
+import json
 import math
 import os
 import random
 import re
-from typing import List, Optional
+import typing
+from typing import Callable, List, Optional
 import jinja2
-from utils import get_assistant_response
+from utils import get_assistant_response, get_response_format
+from grading import grade_flashcard
 
 from pydantic import BaseModel, Field, ValidationError
 
@@ -65,6 +69,36 @@ class FlashCardExampleSchema(BaseModel):
         extra = 'forbid'
 
 
+class WordTestBatchItemSchema(BaseModel):
+    word: str
+    test: WordTestSchema
+
+    class Config:
+        extra = 'forbid'
+
+
+class WordTestBatchSchema(BaseModel):
+    items: list[WordTestBatchItemSchema]
+
+    class Config:
+        extra = 'forbid'
+
+
+class FlashCardBatchItemSchema(BaseModel):
+    word: str
+    card: FlashCardExampleSchema
+
+    class Config:
+        extra = 'forbid'
+
+
+class FlashCardBatchSchema(BaseModel):
+    items: list[FlashCardBatchItemSchema]
+
+    class Config:
+        extra = 'forbid'
+
+
 class FlashcardCorrectionSchema(BaseModel):
     translation_score: int
     score_justification: str
@@ -73,6 +107,48 @@ class FlashcardCorrectionSchema(BaseModel):
         extra = 'forbid'
 
 
+# marks a required field of a streamed response that has not arrived yet, a partial message ends before it
+_MISSING = '\x00'
+
+
+def _item_model(annotation):
+    # the pydantic model in an annotation such as list[Model] or Optional[Model]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    for arg in typing.get_args(annotation):
+        model = _item_model(arg)
+        if model is not None:
+            return model
+    return None
+
+
+def _with_missing_fields(partial: dict, model) -> dict:
+    """Fills the fields of a partial response that have not arrived yet: optional ones with None, others with _MISSING."""
+    res = dict()
+    for name, field in model.model_fields.items():
+        if name not in partial:
+            res[name] = None if type(None) in typing.get_args(field.annotation) else _MISSING
+            continue
+        value = partial[name]
+        item_model = _item_model(field.annotation)
+        if item_model is not None and isinstance(value, list):
+            value = [_with_missing_fields(item, item_model) for item in value if isinstance(item, dict)]
+        elif item_model is not None and isinstance(value, dict):
+            value = _with_missing_fields(value, item_model)
+        res[name] = value
+    return res
+
+
+def _render_partial(template: jinja2.Template, **kwargs) -> Optional[str]:
+    # renders the message up to the first missing field, None if it cannot be rendered yet
+    try:
+        message = template.render(**kwargs)
+    except (TypeError, jinja2.UndefinedError):
+        return None
+    message = message.split(_MISSING)[0].rstrip()
+    return message if len(message) > 0 else None
+
+
 class WordsExerciseLearn(Exercise):
     def __init__(self, word, meaning, word_id, lang, uilang, num_reps, interface, templates):
         super().__init__()
@@ -88,29 +164,28 @@ class WordsExerciseLearn(Exercise):
         self.model_substitute = os.getenv('MODEL_SUBSTITUTE')
         self.is_responded = True
 
-    async def get_next_user_message(self, user_response: Optional[str]) -> tuple[str, int]:
-        message_template = self.templates.get_template(self.uilang, self.lang, 'learn_word_query')
-        template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+    async def get_next_user_message(self, user_response: Optional[str],
+                                    on_partial: Optional[Callable[[str], None]] = None) -> tuple[str, int]:
+        template = self.templates.get_template(self.uilang, self.lang, 'learn_word_query')
         word_phrase = "word" if len(self.word.split()) == 1 else "phrase"
         lang_tr = self.interface[self.lang][self.uilang]
         query = template.render(word_phrase=word_phrase, word=self.word, meaning=self.meaning, lang=lang_tr)
 
-        schema = WordExamplesSchema.model_json_schema()
+        response_format = get_response_format(WordExamplesSchema)
+
+        template = self.templates.get_template(self.uilang, self.lang, 'learn_word_user_message')
 
-        response_format = {
-            "type": "json_schema",
-            "json_schema": {"strict": True,
-                            "name": "word_example",
-                            "schema": schema
-                            }
-        }
+        def on_partial_response(partial):
+            fields = _with_missing_fields(partial, WordExamplesSchema)
+            message = _render_partial(template, word=self.word, examples=fields['example_list'] if fields['example_list'] != _MISSING else [],
+                                      conjugations=fields['conjugations'], pronunciation=fields['pronunciation'])
+            if message is not None:
+                on_partial(message)
 
         assistant_response = await get_assistant_response(self.interface, query, uilang=self.uilang, model_base=self.model_base,
-                                                          model_substitute=self.model_substitute, response_format=response_format, validation_cls=WordExamplesSchema)
-        
-        message_template = self.templates.get_template(self.uilang, self.lang, 'learn_word_user_message')
-        # examples = [(entry.example_sentence, entry.sentence_translation) for entry in assistant_response.example_list]
-        template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+                                                          model_substitute=self.model_substitute, response_format=response_format, validation_cls=WordExamplesSchema,
+                                                          use_cache=True, on_partial=on_partial_response if on_partial is not None else None)
+
         message = template.render(word=self.word, examples=assistant_response.example_list, conjugations=assistant_response.conjugations, pronunciation=assistant_response.pronunciation)
         return message, None
 
@@ -143,68 +218,63 @@ class WordsExerciseTest(Exercise):
     def test_sentence(self):
         return self.assistant_responses[0][self.difficulty - 1]['test']
 
-    async def get_next_user_message(self, user_response: Optional[str]):
+    def first_query(self) -> str:
+        template = self.templates.get_template(self.uilang, self.lang, 'test_word_query_1')
+        return template.render(word=self.word, lang=self.interface[self.lang][self.uilang], level=self.level)
+
+    def start(self, assistant_response: WordTestSchema) -> str:
+        """Stores the generated examples and returns the first message to the user."""
         lang_tr = self.interface[self.lang][self.uilang]
+        examples = sorted(assistant_response.example_list, key=lambda x: x.difficulty)
+        examples = [dict(test=item.sentence_translation, answer=item.example_sentence) for item in examples]
+
+        self.difficulty = 3
+
+        self.assistant_responses.append(examples)
+
+        template = self.templates.get_template(self.uilang, self.lang, 'test_word_user_message_1')
+        return template.render(lang=lang_tr, test_sentence=self.test_sentence())
+
+    async def get_next_user_message(self, user_response: Optional[str], on_partial: Optional[Callable[[str], None]] = None):
         if user_response is None:
             # first message to the user
-
-            message_template = self.templates.get_template(self.uilang, self.lang, 'test_word_query_1')
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
-            query = template.render(word=self.word, lang=lang_tr, level=self.level)
+            query = self.first_query()
 
             validation_cls = WordTestSchema
-            schema = validation_cls.model_json_schema()
-
-            response_format = {
-                "type": "json_schema",
-                "json_schema": {"strict": True,
-                                "name": "word_example",
-                                "schema": schema
-                                }
-            }
+            response_format = get_response_format(validation_cls)
 
             assistant_response = await get_assistant_response(self.interface, query, model_base=self.model_base,
                                                         model_substitute=self.model_substitute, uilang=self.uilang,
-                                                        response_format=response_format, validation_cls=validation_cls)
-            
-            examples = sorted(assistant_response.example_list, key=lambda x: x.difficulty)
-            examples = [dict(test=item.sentence_translation, answer=item.example_sentence) for item in examples]
-
-            self.difficulty = 3
-
-            self.assistant_responses.append(examples)
-
-            message_template = self.templates.get_template(self.uilang, self.lang, 'test_word_user_message_1')
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
-            message = template.render(lang=lang_tr, test_sentence=self.test_sentence())
+                                                        response_format=response_format, validation_cls=validation_cls,
+                                                        use_cache=True)
+            message = self.start(assistant_response)
             quality = None
             
         else:
             self.user_messages.append(user_response)
 
-            message_template = self.templates.get_template(self.uilang, self.lang, 'test_word_query_2')
-
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+            template = self.templates.get_template(self.uilang, self.lang, 'test_word_query_2')
             query = template.render(lang=self.interface[self.lang][self.uilang],
                                     user_response=user_response, sentence=self.test_sentence(),
                                     word=self.word)
 
             validation_cls = ResponseCorrectionSchema
-            schema = validation_cls.model_json_schema()
+            response_format = get_response_format(validation_cls)
 
-            response_format = {
-                "type": "json_schema",
-                "json_schema": {"strict": True,
-                                "name": "word_example",
-                                "schema": schema
-                                }
-            }
+            template = self.templates.get_template(self.uilang, self.lang, 'test_word_user_message_2')
+
+            def on_partial_response(partial):
+                fields = _with_missing_fields(partial, validation_cls)
+                message = _render_partial(template, score=fields['translation_score'], justification=fields['score_justification'],
+                                          explanation=fields['mistakes_explanation'], corrected_translation=fields['corrected_translation'],
+                                          original_translation=self.correct_answer())
+                if message is not None:
+                    on_partial(message)
 
             assistant_response = await get_assistant_response(self.interface, query, model_base=self.model_base,
                                                         model_substitute=self.model_substitute, uilang=self.uilang,
-                                                        response_format=response_format, validation_cls=validation_cls)
-            message_template = self.templates.get_template(self.uilang, self.lang, 'test_word_user_message_2')
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+                                                        response_format=response_format, validation_cls=validation_cls,
+                                                        on_partial=on_partial_response if on_partial is not None else None)
             message = template.render(score=assistant_response.translation_score,
                                   justification=assistant_response.score_justification,
                                   explanation=assistant_response.mistakes_explanation,
@@ -223,8 +293,7 @@ class WordsExerciseTest(Exercise):
         else:
             self.difficulty = min(5, self.difficulty + 1)
 
-        message_template = self.templates.get_template(self.uilang, self.lang, 'test_word_user_message_1')
-        template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+        template = self.templates.get_template(self.uilang, self.lang, 'test_word_user_message_1')
         message = template.render(lang=lang_tr, test_sentence=self.test_sentence())
         return message
 
@@ -253,62 +322,68 @@ class FlashcardExercise(Exercise):
     def correct_answer(self):
         return f'{self.word}\n\n{self.interface["Example"][self.uilang]}: {self.assistant_responses[0]["example"]}'
 
-    async def get_next_user_message(self, user_response: Optional[str]):
+    def first_query(self) -> str:
+        template = self.templates.get_template(self.uilang, self.lang, 'flashcard_query_1')
+        return template.render(word=self.word, level=self.level, lang=self.interface[self.lang][self.uilang], lang_ui=self.uilang)
+
+    def start(self, assistant_response: FlashCardExampleSchema) -> str:
+        """Stores the generated example and returns the first message to the user."""
         lang_tr = self.interface[self.lang][self.uilang]
+        self.assistant_responses.append(dict(example=assistant_response.example, translation_example=assistant_response.translation_of_example,
+                                             translation_word=assistant_response.translation_of_word))
+
+        template = self.templates.get_template(self.uilang, self.lang, 'flashcard_user_message_1')
+        return template.render(lang=lang_tr, lang_ui=self.uilang, word=assistant_response.translation_of_word, example=assistant_response.translation_of_example)
+
+    async def grade(self, user_response: str, on_partial: Optional[Callable[[dict], None]] = None) -> FlashcardCorrectionSchema:
+        template = self.templates.get_template(self.uilang, self.lang, 'flashcard_query_2')
+        query = template.render(lang=self.interface[self.lang][self.uilang], user_response=user_response,
+                                word_translation=self.assistant_responses[-1]['translation_word'], correct_answer=self.word)
+
+        validation_cls = FlashcardCorrectionSchema
+        response_format = get_response_format(validation_cls)
+
+        return await get_assistant_response(self.interface, query, model_base=self.model_base,
+                                            model_substitute=self.model_substitute, uilang=self.uilang,
+                                            response_format=response_format, validation_cls=validation_cls,
+                                            on_partial=on_partial)
+
+    async def get_next_user_message(self, user_response: Optional[str], on_partial: Optional[Callable[[str], None]] = None):
         if user_response is None:
             # first message to the user
-            message_template = self.templates.get_template(self.uilang, self.lang, 'flashcard_query_1')
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
-            query = template.render(word=self.word, level=self.level, lang=lang_tr, lang_ui=self.uilang)
+            query = self.first_query()
 
             validation_cls = FlashCardExampleSchema
-            schema = validation_cls.model_json_schema()
-
-            response_format = {
-                "type": "json_schema",
-                "json_schema": {"strict": True,
-                                "name": "word_example",
-                                "schema": schema
-                                }
-            }
+            response_format = get_response_format(validation_cls)
 
             assistant_response = await get_assistant_response(self.interface, query, model_base=self.model_base,
                                                         model_substitute=self.model_substitute, uilang=self.uilang,
-                                                        response_format=response_format, validation_cls=validation_cls)
-            
-            self.assistant_responses.append(dict(example=assistant_response.example, translation_example=assistant_response.translation_of_example,
-                                                 translation_word=assistant_response.translation_of_word))
-
-            message_template = self.templates.get_template(self.uilang, self.lang, 'flashcard_user_message_1')
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
-            message = template.render(lang=lang_tr, lang_ui=self.uilang, word=assistant_response.translation_of_word, example=assistant_response.translation_of_example)
+                                                        response_format=response_format, validation_cls=validation_cls,
+                                                        use_cache=True)
+            message = self.start(assistant_response)
             quality = None
             
         else:
             self.user_messages.append(user_response)
-
-            message_template = self.templates.get_template(self.uilang, self.lang, 'flashcard_query_2')
-
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
-            query = template.render(lang=self.interface[self.lang][self.uilang], user_response=user_response,
-                                    word_translation=self.assistant_responses[-1]['translation_word'], correct_answer=self.word)
-
-            validation_cls = FlashcardCorrectionSchema
-            schema = validation_cls.model_json_schema()
-
-            response_format = {
-                "type": "json_schema",
-                "json_schema": {"strict": True,
-                                "name": "word_example",
-                                "schema": schema
-                                }
-            }
-
-            assistant_response = await get_assistant_response(self.interface, query, model_base=self.model_base,
-                                                        model_substitute=self.model_substitute, uilang=self.uilang,
-                                                        response_format=response_format, validation_cls=validation_cls)
-            message_template = self.templates.get_template(self.uilang, self.lang, 'flashcard_user_message_2')
-            template = jinja2.Template(message_template, undefined=jinja2.StrictUndefined)
+            template = self.templates.get_template(self.uilang, self.lang, 'flashcard_user_message_2')
+
+            def on_partial_response(partial):
+                fields = _with_missing_fields(partial, FlashcardCorrectionSchema)
+                score = fields['translation_score']
+                message = _render_partial(template, score=score, justification=fields['score_justification'],
+                                          correct_answer=self.word if isinstance(score, int) and score < 5 else None,
+                                          context_translation=self.assistant_responses[-1]['example'])
+                if message is not None:
+                    on_partial(message)
+
+            # clear-cut answers are graded locally, only the others are sent to the assistant
+            local_grade = grade_flashcard(user_response, self.word)
+            if local_grade is not None:
+                score, justification = local_grade
+                assistant_response = FlashcardCorrectionSchema(translation_score=score,
+                                                               score_justification=self.interface[justification][self.uilang])
+            else:
+                assistant_response = await self.grade(user_response, on_partial=on_partial_response if on_partial is not None else None)
             correct_answer = self.word if assistant_response.translation_score < 5 else None
             context_translation = self.assistant_responses[-1]['example']
             message = template.render(score=assistant_response.translation_score,
@@ -318,3 +393,69 @@ class FlashcardExercise(Exercise):
             quality = assistant_response.translation_score
 
         return message, quality
+
+
+# exercise class -> (batch query template, batch schema, field of a batch item with the response for one word, its schema)
+BATCH_GENERATION = {
+    FlashcardExercise: ('flashcard_query_batch', FlashCardBatchSchema, 'card', FlashCardExampleSchema),
+    WordsExerciseTest: ('test_word_query_batch', WordTestBatchSchema, 'test', WordTestSchema),
+}
+
+
+async def generate_first_messages(exercises: List[Exercise], max_batch_size=8) -> List[Optional[str]]:
+    """Generates first messages of many exercises with one request per up to max_batch_size words.
+
+    Exercises of the same type, languages and level share a request, words are deduplicated. Exercises whose word is
+    missing or invalid in the batch response, and exercises that cannot be batched, are generated one by one.
+    Returns the first message of every exercise, None if it could not be generated.
+    """
+    messages = [None] * len(exercises)
+    groups = dict()
+    for idx, exercise in enumerate(exercises):
+        if type(exercise) in BATCH_GENERATION:
+            groups.setdefault((type(exercise), exercise.lang, exercise.uilang, exercise.level), []).append(idx)
+
+    for (exercise_cls, lang, uilang, level), idxs in groups.items():
+        words = list(dict.fromkeys(exercises[idx].word for idx in idxs))
+        if len(words) < 2:
+            continue
+        template_name, batch_cls, field, item_cls = BATCH_GENERATION[exercise_cls]
+        first = exercises[idxs[0]]
+        try:
+            template = first.templates.get_template(uilang, lang, template_name)
+        except KeyError:
+            continue
+        response_format = get_response_format(batch_cls, name='word_example_batch')
+
+        for start in range(0, len(words), max_batch_size):
+            batch_words = words[start:start + max_batch_size]
+            query = template.render(words=batch_words, lang=first.interface[lang][uilang], lang_ui=uilang, level=level)
+            try:
+                content = await get_assistant_response(first.interface, query, model_base=first.model_base,
+                                                       model_substitute=first.model_substitute, uilang=uilang,
+                                                       response_format=response_format, max_tokens=600 * len(batch_words))
+                items = json.loads(content)['items']
+            except Exception as e:
+                print(f'Batch generation of {len(batch_words)} words failed: {e}')
+                continue
+
+            # items are validated one by one, so that one broken item only costs a request for its word
+            responses = dict()
+            for item in items:
+                try:
+                    responses[item['word']] = item_cls.model_validate(item[field])
+                except (KeyError, TypeError, ValidationError) as e:
+                    print(f'Invalid item in a batch response: {type(e).__name__}')
+            for idx in idxs:
+                response = responses.get(exercises[idx].word)
+                if response is not None and exercises[idx].word in batch_words:
+                    messages[idx] = exercises[idx].start(response)
+
+    async def generate_one(idx):
+        try:
+            messages[idx], _ = await exercises[idx].get_next_user_message(user_response=None)
+        except Exception as e:
+            print(f'Could not generate an exercise for "{exercises[idx].word}": {e}')
+
+    await asyncio.gather(*[generate_one(idx) for idx in range(len(exercises)) if messages[idx] is None])
+    return messages
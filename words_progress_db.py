@@ -1,96 +1,259 @@
-import os.path
 import threading
 from typing import Optional
 
+import numpy as np
 import pandas as pd
 
 from item import Item
 
 
+# values of the rows that are allocated but not in use yet
+_FREE_ROW = dict(chat_id=0, word_id=0, num_reps=0.0, e_factor=2.5, last_interval=0, last_review_date=pd.NaT,
+                 next_review_date=None, to_ignore=False)
+
+
 class WordsProgressDB:
-    def __init__(self, db_path):
-        self.db_path = db_path
-        if not os.path.exists(self.db_path):
-            self.progress_df = pd.DataFrame(columns=['chat_id', 'word_id', 'num_reps', 'e_factor', 'last_interval', 'last_review_date', 'next_review_date', 'to_ignore'])
-        self.progress_df = pd.read_csv(self.db_path)
-        self.progress_df['last_review_date'] = pd.to_datetime(self.progress_df['last_review_date'])
-        self.progress_df['next_review_date'] = pd.to_datetime(self.progress_df['next_review_date']).dt.date
-        self.progress_df['word_id'] = self.progress_df['word_id'].astype(int)
-        self.progress_df['chat_id'] = self.progress_df['chat_id'].astype(int)
+    """Progress of all users in one in-memory table, every change is reported to the storage.
+
+    The table has spare rows, the rows in use are the first ones. Adding a row takes a spare row, the table doubles
+    when none is left. Removing rows moves the last rows into their place. So a change costs time proportional to
+    the number of changed rows, not to the size of the table.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        progress_df = self.storage.load('progress')
+        progress_df['last_review_date'] = pd.to_datetime(progress_df['last_review_date'], format='ISO8601').astype('datetime64[us]')
+        progress_df['next_review_date'] = pd.to_datetime(progress_df['next_review_date'], format='ISO8601').dt.date
+        progress_df['word_id'] = progress_df['word_id'].astype(int)
+        progress_df['chat_id'] = progress_df['chat_id'].astype(int)
+        # an empty table is read with object columns
+        progress_df = progress_df.astype(dict(num_reps=float, e_factor=float, last_interval=int))
+        self._table = progress_df.reset_index(drop=True)
+        self._n_rows = len(self._table)
+        self._build_index()
+        # the spare rows are allocated at the start, so that the first new rows do not grow the table
+        self._grow(self._n_rows // 2)
+        # readers share a snapshot of the rows in use, taken by the first read after a change. It is a view of the
+        # table, copy on write keeps it unchanged: the first write after it copies the columns it writes to.
+        self.version = 0
+        self._snapshot = None
+        self._listeners = []
         self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+
+    def __len__(self):
+        return self._n_rows
+
+    def _build_index(self):
+        # (chat_id, word_id) -> row label in the table, labels are the positions of the rows
+        self._index = dict()
+        for label, chat_id, word_id in zip(range(self._n_rows), self._table['chat_id'], self._table['word_id']):
+            key = (int(chat_id), int(word_id))
+            if key in self._index:
+                raise ValueError(f'Progress of word {word_id} for chat {chat_id} appears >1 time in the database.')
+            self._index[key] = label
+
+    def _grow(self, n_spare) -> None:
+        # adds rows to the table so that it has at least n_spare spare rows
+        capacity = max(self._n_rows + n_spare, 1024)
+        if capacity <= len(self._table):
+            return
+        index = pd.RangeIndex(len(self._table), capacity)
+        free_rows = pd.DataFrame({col: pd.Series(_FREE_ROW[col], index=index, dtype=dtype) for col, dtype in self._table.dtypes.items()})
+        self._table = pd.concat([self._table, free_rows])
+
+    def _allocate(self, n) -> int:
+        # must be called with the lock held, returns the label of the first of n new rows
+        if self._n_rows + n > len(self._table):
+            self._grow(max(self._n_rows, n))
+        label = self._n_rows
+        self._n_rows += n
+        return label
+
+    def _release(self, labels) -> None:
+        # must be called with the lock held and the keys of labels already removed from the index
+        labels = set(labels)
+        n_rows = self._n_rows - len(labels)
+        # the rows in use after the last one that is kept fill the holes
+        holes = sorted(label for label in labels if label < n_rows)
+        moved = [label for label in range(n_rows, self._n_rows) if label not in labels]
+        if 0 < len(holes) <= 16:
+            # setting cells one by one is faster for a few rows
+            at = self._table.at
+            for hole, label in zip(holes, moved):
+                for col in self._table.columns:
+                    at[hole, col] = at[label, col]
+        elif len(holes) > 16:
+            for pos in range(self._table.shape[1]):
+                self._table.iloc[holes, pos] = self._table.iloc[moved, pos].to_numpy()
+        if len(holes) > 0:
+            for label, chat_id, word_id in zip(holes, self._table['chat_id'].iloc[holes], self._table['word_id'].iloc[holes]):
+                self._index[(int(chat_id), int(word_id))] = label
+        self._n_rows = n_rows
+
+    def add_listener(self, callback):
+        # callback(chat_id, word_id, progress) is called after every change, progress is None if the row was removed
+        self._listeners.append(callback)
+
+    def _progress_state(self, key):
+        # must be called with the lock held
+        label = self._index.get(key)
+        if label is None:
+            return None
+        at = self._table.at
+        return dict(num_reps=at[label, 'num_reps'], e_factor=at[label, 'e_factor'], last_interval=at[label, 'last_interval'],
+                    last_review_date=at[label, 'last_review_date'], next_review_date=at[label, 'next_review_date'],
+                    to_ignore=at[label, 'to_ignore'])
+
+    def _notify(self, changes):
+        # must be called without the lock, listeners may read the db
+        for chat_id, word_id, progress in changes:
+            for callback in self._listeners:
+                callback(chat_id, word_id, progress)
+
+    def _touch(self):
+        # must be called with the lock held after every change of the table
+        self.version += 1
+        self._snapshot = None
 
     def get_progress_df(self):
-        self._lock.acquire()
-        pdf_cpy = self.progress_df.copy()
-        self._lock.release()
-        return pdf_cpy
+        # the returned DataFrame is shared between callers and must not be modified
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._table.iloc[:self._n_rows]
+            return self._snapshot
 
     def save_progress(self):
-        self._lock.acquire()
-        self.progress_df.to_csv(self.db_path, index=False)
-        self._lock.release()
+        with self._lock:
+            self.storage.commit('progress', self._table.iloc[:self._n_rows])
+
+    def compact(self):
+        # only the snapshot and the rotation of the storage are done under the lock, the snapshot is written without
+        # it. The snapshot is a view of the table, copy on write keeps it unchanged by the writes in the meantime.
+        with self._compact_lock:
+            with self._lock:
+                snapshot = self._table.iloc[:self._n_rows]
+                self.storage.rotate('progress')
+            self.storage.compact('progress', snapshot)
+
+    def _add_word_to_progress(self, chat_id, word_id):
+        # must be called with the lock held
+        key = (int(chat_id), int(word_id))
+        if key in self._index:
+            raise ValueError(f'Progress of word {word_id} for chat {chat_id} already exists.')
+        label = self._allocate(1)
+        new_progress = {'chat_id': int(chat_id), 'word_id': int(word_id), 'num_reps': 0.0, 'to_ignore': False,
+                        'e_factor': 2.5, 'last_interval': 0, 'last_review_date': None, 'next_review_date': None}
+        for col, value in new_progress.items():
+            self._table.at[label, col] = pd.NaT if col == 'last_review_date' and value is None else value
+        self._index[key] = label
+        self._touch()
+        self.storage.insert('progress', new_progress)
 
     def add_word_to_progress(self, chat_id, word_id):
-        self._lock.acquire()
-        new_row = pd.DataFrame([{'chat_id': chat_id, 'word_id': word_id, 'num_reps': 0.0, 'to_ignore': False,
-             'e_factor': 2.5, 'last_interval': 0, 'last_review_date': None, 'next_review_date': None}])[self.progress_df.columns].astype(self.progress_df.dtypes)
-        self.progress_df = pd.concat([self.progress_df, new_row], ignore_index=True)
-        self._lock.release()
+        key = (int(chat_id), int(word_id))
+        with self._lock:
+            self._add_word_to_progress(chat_id, word_id)
+            progress = self._progress_state(key)
+        self._notify([(key[0], key[1], progress)])
 
     def ignore_word(self, chat_id, word_id):
-        self._lock.acquire()
-        chat_word_progress = self.progress_df[(self.progress_df['chat_id'] == chat_id) &
-                                              (self.progress_df['word_id'] == word_id)]
-        if chat_word_progress.shape[0] == 0:
-            self.add_word_to_progress(chat_id, word_id)
-
-        mask = (self.progress_df['chat_id'] == chat_id) & (self.progress_df['word_id'] == word_id)
-        if self.progress_df[mask].shape[0] != 1:
-            self._lock.release()
-            raise ValueError('Number of rows satisfying the condition must be exactly 1.')
-        self.progress_df.loc[mask, 'to_ignore'] = True
-        self._lock.release()
+        key = (int(chat_id), int(word_id))
+        with self._lock:
+            if key not in self._index:
+                self._add_word_to_progress(chat_id, word_id)
+            self._table.at[self._index[key], 'to_ignore'] = True
+            self._touch()
+            self.storage.update('progress', dict(chat_id=key[0], word_id=key[1]), dict(to_ignore=True))
+            progress = self._progress_state(key)
+        self._notify([(key[0], key[1], progress)])
 
     def get_word_progress(self, chat_id, word_id) -> Optional[Item]:
-        self._lock.acquire()
-        chat_word_progress = self.progress_df[(self.progress_df['chat_id'] == chat_id) &
-                                              (self.progress_df['word_id'] == word_id)]
-        if chat_word_progress.shape[0] == 0:
-            self._lock.release()
-            return None
+        with self._lock:
+            label = self._index.get((int(chat_id), int(word_id)))
+            if label is None:
+                return None
 
-        mask = (self.progress_df['chat_id'] == chat_id) & (self.progress_df['word_id'] == word_id)
-        row = self.progress_df[mask]
-        if row.shape[0] != 1:
-            self._lock.release()
-            raise ValueError('Number of rows satisfying the condition must be exactly 1.')
-        item = Item(e_factor=row['e_factor'].item(), num_reps=row['num_reps'].item(),
-                    next_review_date=row['next_review_date'].item(), last_review_date=row['last_review_date'].item(),
-                    last_interval=row['last_interval'].item(), word_id=word_id)
-        self._lock.release()
-        return item
+            at = self._table.at
+            return Item(e_factor=at[label, 'e_factor'].item(), num_reps=at[label, 'num_reps'].item(),
+                        next_review_date=at[label, 'next_review_date'], last_review_date=at[label, 'last_review_date'],
+                        last_interval=at[label, 'last_interval'].item(), word_id=word_id)
 
     def set_word_progress(self, chat_id, word_id, item) -> None:
-        self._lock.acquire()
-        mask = (self.progress_df['chat_id'] == chat_id) & (self.progress_df['word_id'] == word_id)
-
-        chat_word_progress = self.progress_df[mask]
-        if chat_word_progress.shape[0] != 1:
-            self._lock.release()
-            raise ValueError(f'Number of rows satisfying the condition must be exactly 1, found {chat_word_progress.shape[0]}.')
-        self.progress_df.loc[mask, 'num_reps'] = item.num_reps
-        self.progress_df.loc[mask, 'e_factor'] = item.e_factor
-        self.progress_df.loc[mask, 'next_review_date'] = item.next_review_date
-        self.progress_df.loc[mask, 'last_review_date'] = item.last_review_date
-        self.progress_df.loc[mask, 'last_interval'] = item.last_interval
-        self._lock.release()
+        with self._lock:
+            label = self._index.get((int(chat_id), int(word_id)))
+            if label is None:
+                raise ValueError(f'Progress of word {word_id} for chat {chat_id} is not found.')
+            values = dict(num_reps=item.num_reps, e_factor=item.e_factor, next_review_date=item.next_review_date,
+                          last_review_date=item.last_review_date, last_interval=item.last_interval)
+            for col, value in values.items():
+                self._table.at[label, col] = value
+            self._touch()
+            self.storage.update('progress', dict(chat_id=int(chat_id), word_id=int(word_id)), values)
+            progress = self._progress_state((int(chat_id), int(word_id)))
+        self._notify([(int(chat_id), int(word_id), progress)])
+
+    def get_progress_batch(self, keys) -> pd.DataFrame:
+        # keys is a list of (chat_id, word_id), returns progress of the keys that exist in the db
+        with self._lock:
+            labels = [self._index[(int(chat_id), int(word_id))] for chat_id, word_id in keys if (int(chat_id), int(word_id)) in self._index]
+            return self._table.loc[labels].copy()
+
+    def set_progress_batch(self, progress: pd.DataFrame) -> None:
+        """Sets progress of all rows of progress at once, rows that do not exist yet are added.
+
+        progress must have columns chat_id, word_id, num_reps, e_factor, last_interval, last_review_date and
+        next_review_date, a key must appear at most once.
+        """
+        cols = ['num_reps', 'e_factor', 'last_interval', 'last_review_date', 'next_review_date']
+        keys = [(int(chat_id), int(word_id)) for chat_id, word_id in zip(progress['chat_id'], progress['word_id'])]
+        with self._lock:
+            new_mask = np.array([key not in self._index for key in keys], dtype=bool)
+            if new_mask.any():
+                new_rows = progress.loc[new_mask, ['chat_id', 'word_id'] + cols].copy()
+                new_rows['to_ignore'] = False
+                new_rows = new_rows[self._table.columns].astype(self._table.dtypes)
+                start = self._allocate(new_rows.shape[0])
+                for pos, col in enumerate(self._table.columns):
+                    self._table.iloc[start:start + new_rows.shape[0], pos] = new_rows[col].to_numpy()
+                for key, label in zip([k for k, is_new in zip(keys, new_mask) if is_new], range(start, start + new_rows.shape[0])):
+                    self._index[key] = label
+                for row in new_rows.to_dict('records'):
+                    self.storage.insert('progress', row)
+
+            existing = progress.loc[~new_mask]
+            if existing.shape[0] > 0:
+                labels = [self._index[key] for key, is_new in zip(keys, new_mask) if not is_new]
+                for col in cols:
+                    self._table.loc[labels, col] = existing[col].values
+                for key, values in zip([k for k, is_new in zip(keys, new_mask) if not is_new], existing[cols].to_dict('records')):
+                    self.storage.update('progress', dict(chat_id=key[0], word_id=key[1]), values)
+            self._touch()
+            changes = [(key[0], key[1], self._progress_state(key)) for key in keys]
+        self._notify(changes)
 
     def remove_progress(self, chat_id, word_ids):
-        self._lock.acquire()
-        mask = (self.progress_df['chat_id'] == chat_id) & (self.progress_df['word_id'].isin(word_ids))
-        self.progress_df = self.progress_df[~mask]
-        self._lock.release()
-
-    def release_lock(self):
-        if self._lock.locked():
-            self._lock.release()
\ No newline at end of file
+        with self._lock:
+            labels = [self._index.pop((int(chat_id), int(word_id))) for word_id in word_ids
+                      if (int(chat_id), int(word_id)) in self._index]
+            if len(labels) > 0:
+                self._release(labels)
+                self._touch()
+                self.storage.delete('progress', dict(chat_id=int(chat_id), word_id=[int(word_id) for word_id in word_ids]))
+        self._notify([(int(chat_id), int(word_id), None) for word_id in word_ids])
+
+    def remove_progress_batch(self, keys):
+        # keys is a list of (chat_id, word_id)
+        keys = [(int(chat_id), int(word_id)) for chat_id, word_id in keys]
+        with self._lock:
+            labels = [self._index.pop(key) for key in keys if key in self._index]
+            if len(labels) > 0:
+                self._release(labels)
+                self._touch()
+                word_ids = dict()
+                for chat_id, word_id in keys:
+                    word_ids.setdefault(chat_id, []).append(word_id)
+                for chat_id, chat_word_ids in word_ids.items():
+                    self.storage.delete('progress', dict(chat_id=chat_id, word_id=chat_word_ids))
+        self._notify([(chat_id, word_id, None) for chat_id, word_id in keys])